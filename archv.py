@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 from pprint import PrettyPrinter
+import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
 
 import slacker
 import peewee
 
 import settings
 import models as m
+import migrations
 
 token = settings.token
-slack = slacker.Slacker(token)
+slack = slacker.Slacker(token, rate_limit_retries=3)
 pp = PrettyPrinter(indent=2).pprint
 
 def assert_auth():
@@ -32,17 +38,31 @@ def fetch_user_list():
     ''' This is a method to fetch user list. '''
     usrlist = slack.users.list().body['members']
     with m.db.atomic():
+        old = { usr['id']: usr for usr in m.User.select().dicts() }
         m.User.delete().execute()
         m.User.api_bulk_insert(usrlist)
+        new = { usr['id']: usr for usr in m.User.select().dicts() }
+
+        m.ChangeLog.record('user', 'insert', [uid for uid in new if uid not in old])
+        m.ChangeLog.record('user', 'update', [uid for uid in new
+                                              if uid in old and new[uid] != old[uid]])
+        m.ChangeLog.record('user', 'delete', [uid for uid in old if uid not in new])
+
+def fetch_conversation_list(kind):
+    ''' This is a method updating the list of a type of conversations. '''
+    convlist = api(kind.api.list)[kind.list_key]
+    with m.db.atomic():
+        kind.model.delete().execute()
+        for conv in convlist:
+            kind.model.api(conv, True)
+    return convlist
 
 def fetch_channel_list():
     ''' This is a method updating channel list. '''
-    chanlist = slack.channels.list().body['channels']
+    chanlist = fetch_conversation_list(CHANNEL)
     with m.db.atomic():
-        m.Channel.delete().execute()
         m.ChannelUser.delete().execute()
         for chan in chanlist:
-            m.Channel.api(chan, True)
             # Create channel-user relationship for every channel
             chan_id = chan['id']
             m.ChannelUser.api_bulk_insert([
@@ -65,19 +85,32 @@ def process_message(msg):
             insert_reactions(msg['file']['reactions'], 'file', msg['file']['id'])
             del msg['file']['reactions']
 
-        msgfile = m.File.api(msg['file'], True)
+        query = m.File.select().where(m.File.id == msg['file']['id']).dicts()
+        old = query.first()
+        msgfile = m.File.api(msg['file'])
         msg['_file'] = msgfile
 
         # create file comments along the message
         subtype = msg.get('subtype', '')
         comment = None
-        if subtype == 'file_share':
-            if 'initial_comment' in msg['file']:
-                comment = msg['file']['initial_comment']
-                # update the field using simply id
-                msgfile.initial_comment = comment['id']
-                msgfile.save()
-        elif subtype == 'file_comment':
+        if subtype == 'file_share' and 'initial_comment' in msg['file']:
+            comment = msg['file']['initial_comment']
+            # update the field using simply id
+            msgfile.initial_comment = comment['id']
+        elif old is not None:
+            msgfile.initial_comment = old['initial_comment']
+        if old is not None:
+            # not given by the API
+            msgfile.content = old['content']
+        msgfile.save(force_insert=old is None)
+
+        new = query.clone().first()
+        if old is None:
+            m.ChangeLog.record('file', 'insert', [msgfile.id])
+        elif new != old:
+            m.ChangeLog.record('file', 'update', [msgfile.id])
+
+        if subtype == 'file_comment':
             comment = msg['comment']
         if comment is not None:
             if 'reactions' in comment:
@@ -100,157 +133,466 @@ def process_message(msg):
 
     return msg
 
-def insert_reactions(reactions, item_type='message', item_id=None, channel=None):
-    for r in reactions:
-        # clear original reactions at first
-        query = (m.Reaction.delete()
-            .where(m.Reaction.item_type == item_type
-                and m.Reaction.item_id == item_id))
-
+def reaction_rows(reactions, item_type, item_id, channel=None):
+    item = m.Reaction.item_fields(item_type, item_id)
+    return [
+        dict(item, **{
+            'item_type': item_type,
+            'channel': channel,
+            'reaction': r['name'],
+            'user': u
+        }) for r in reactions for u in r['users']
+    ]
+
+def reaction_pairs(rows):
+    return { (row['reaction'], row['user']) for row in rows }
+
+def reaction_models(item_type, item_id, channel=None):
+    ''' Get models storing reactions of an item along with the condition. '''
+    # reactions of messages may be stored in a shard
+    ts = item_id if item_type == 'message' else None
+    for model in m.Reaction.route(ts):
         if item_type == 'message':
-            query = query.where(m.Reaction.channel == channel)
-
-        query.execute()
-
-        # according to documentation, only a limited number of shown users is presented.
-        # requiring one more query to ensure.
-        # for now, we only show a warning.
-        m.Reaction.api_bulk_insert([
-            {
-                'item_type': item_type,
-                'channel': channel,
-                'item_id': item_id,
-                'reaction': r['name'],
-                'user': u
-            } for u in r['users']
-        ])
-        if r['count'] != len(r['users']):
-            # TODO: emit another request to fetch all remaining reactions
-            print('Warning: the reaction of channel #{} at ts={} is not saved completely.'.format(channel.id, ts))
-
-def fetch_channel_message(channel):
-    cnt = 0
-    has_more = True
-
-    result = (m.Message.select(m.Message.ts)
-        .where(m.Message.channel == channel)
-        .order_by(m.Message.ts.desc())
-        .first())
-
-    ts_latest = 1e10
-    ts_oldest = '{:.6f}'.format(result.ts) if result else None
-
-    with m.db.atomic():
-        while has_more:
+            # may match reactions of other messages in the same second; see `match_ts`
+            where = m.match_ts(model.item_id, [item_id]) & (model.channel == channel)
+        else:
+            where = model.item_file == item_id
+        yield model, where & (model.item_type == item_type)
+
+def clear_reactions(item_type, item_id, channel=None):
+    ''' Delete stored reactions of an item.
+        Returns them as pairs of reaction and user. '''
+    key = m.ts_to_key(item_id) if item_type == 'message' else None
+    old = set()
+    for model, where in reaction_models(item_type, item_id, channel):
+        rows = [row for row in model.select(model.id, model.item_id, model.reaction, model.user)
+                .where(where).tuples() if key is None or row[1] == key]
+        old.update(row[2:] for row in rows)
+        model.delete().where(model.id << [row[0] for row in rows]).execute()
+    return old
+
+def log_reactions(item, old, new):
+    ''' Log the difference between pairs of reaction and user of an item. '''
+    item_type, item_id, channel = item
+    item_key = m.Message.key(channel, item_id) if item_type == 'message' else item_id
+    for op, pairs in [('insert', new - old), ('delete', old - new)]:
+        m.ChangeLog.record('reaction', op,
+            ['{}/{}/{}'.format(item_key, *pair) for pair in sorted(pairs)])
 
-            resp = slack.channels.history(
-                oldest=ts_oldest,
-                latest=ts_latest,
-                count=1000,
-                channel=channel.id
-            ).body
-
-            msglist = resp['messages']
-            msglen = len(msglist)
-            cnt += msglen
-
-            for msg in msglist:
-                # add channel information
-                msg['channel'] = channel
-                process_message(msg)
-                if 'reactions' in msg:
-                    insert_reactions(msg['reactions'], 'message', msg['ts'], channel)
-                    del msg['reactions']
+def insert_reactions(reactions, item_type='message', item_id=None, channel=None):
+    item = (item_type, item_id, channel)
+    # clear original reactions at first
+    old = clear_reactions(*item)
+    rows = reaction_rows(reactions, *item)
+    m.Reaction.api_bulk_insert(rows)
+
+    key = m.IncompleteReaction.key(*item)
+    queued = m.IncompleteReaction.getBy('id', key)
+    if queued is not None:
+        # logged against what was stored before the first truncated ones
+        old, _ = queued.pairs
+
+    # according to documentation, only a limited number of shown users is presented.
+    # requiring one more query to ensure.
+    if any(r['count'] != len(r['users']) for r in reactions):
+        m.IncompleteReaction.insert(id=key, old=sorted(old),
+            truncated=sorted(reaction_pairs(rows))).upsert().execute()
+    else:
+        if queued is not None:
+            queued.delete_instance()
+        log_reactions(item, old, reaction_pairs(rows))
+
+def fetch_incomplete_reactions():
+    ''' Fetch all reactions of items queued during fetching messages,
+        this run or one stopped before, replacing the truncated ones in bulk. '''
+    items = {queued.item: queued.pairs for queued in m.IncompleteReaction.select()}
+    results = []
+    failed = []
+
+    def job(item):
+        item_type, item_id, channel = item
+        if item_type == 'message':
+            kwargs = {'channel': channel, 'timestamp': item_id}
+        elif item_type == 'file':
+            kwargs = {'file_': item_id}
+        else:
+            kwargs = {'file_comment': item_id}
+        kwargs['full'] = True
 
-            m.Message.api_bulk_insert(msglist)
+        def on_error(err):
+            failed.append((item, err))
 
-            if msglen:
-                # the list is always sorted by ts desc
-                ts_latest = msglist[-1]['ts']
+        return Job(slack.reactions.get, kwargs,
+            lambda resp: results.append((item, resp)), on_error)
 
-            has_more = resp['has_more']
+    run_jobs([job(item) for item in items])
 
-    return cnt
+    rows = []
+    with m.db.atomic():
+        for item, resp in results:
+            item_type, item_id, channel = item
+            if item_type == 'file_comment':
+                reactions = resp['comment'].get('reactions', [])
+            else:
+                reactions = resp[item_type].get('reactions', [])
+            clear_reactions(*item)
+            new_rows = reaction_rows(reactions, *item)
+            log_reactions(item, items[item][0], reaction_pairs(new_rows))
+            rows.extend(new_rows)
+        m.Reaction.api_bulk_insert(rows)
+        done = [item for item, _ in results]
+        for item, err in failed:
+            if str(err).endswith(('_not_found', '_deleted')):
+                # deleted since, so the truncated reactions are kept
+                log_reactions(item, *items[item])
+                done.append(item)
+        m.IncompleteReaction.delete().where(
+            m.IncompleteReaction.id << [m.IncompleteReaction.key(*item) for item in done]).execute()
+
+    for item, err in failed:
+        item_type, item_id, channel = item
+        print(' Warning: reactions of {} {} are not saved completely{}: {}'.format(
+            item_type, item_id if channel is None else channel + '/' + item_id,
+            '' if item in done else ', to be fetched again next time', err))
+
+    return len(results)
+
+def prepare_message(msg, conv_id):
+    ''' Add conversation information and save the items along the message,
+        leaving it ready for insertion. '''
+    msg['channel'] = conv_id
+    process_message(msg)
+    if 'reactions' in msg:
+        insert_reactions(msg['reactions'], 'message', msg['ts'], conv_id)
+        del msg['reactions']
+    return msg
 
-def fetch_channel_message_diff(channel):
-    ''' FIXME: dirty workaround. DRY solution needed.
-        todo: update attachments as well. '''
+def is_thread_parent(msg):
+    return msg.get('thread_ts', None) == msg['ts']
+
+def latest_reply(msg):
+    ''' Get ts of the latest reply of a thread parent.
+        Older responses come with a list of replies instead of `latest_reply`. '''
+    if 'latest_reply' in msg:
+        return msg['latest_reply']
+    replies = msg.get('replies', None)
+    return replies[-1]['ts'] if replies else None
+
+def update_message(msg_ori, msg, conv_id):
+    ''' Overwrite a stored message with the one on Slack, taking its id. '''
+    # FIXME: prevent duplicating objects
+    prepare_message(msg, conv_id)
+    # the original may be stored in a shard
+    msg_new = type(msg_ori).api(msg)
+    msg_new.id = msg_ori.id
+    msg_new.save()
+    return msg_new
+
+def update_thread_parent(msg_ori, msg, conv_id):
+    ''' Update what a thread parent tells about its replies,
+        keeping the files and attachments saved along. '''
+    raw = {key: val for key, val in msg.items() if key not in ['file', 'attachments', 'reactions']}
+    msg_ori.raw = m.Message._transform(raw)['raw']
+    msg_ori.save()
+    insert_reactions(msg.get('reactions', []), 'message', msg['ts'], conv_id)
+    return msg_ori
+
+def save_thread_replies(conv_id, thread_ts, msglist):
+    ''' Bring the stored replies of a thread in line with the ones on Slack.
+        Replies not edited since they were saved are kept as they are,
+        along with their files and attachments, and so is the parent.
+        Returns the number of replies not saved before. '''
+    # the parent is always included in the response
+    replies = { m.ts_to_key(msg['ts']): msg for msg in msglist if msg['ts'] != thread_ts }
+    parent = m.ts_to_key(thread_ts)
+
+    old = {}
+    for model in m.Message.partitions(since=thread_ts):
+        # replies saved before their thread_ts was are found by ts
+        where = (model.channel == conv_id) & (
+            (model.thread_ts == parent) | m.match_ts(model.ts, replies))
+        for msg in model.select().where(where):
+            if msg.ts in replies or (msg.thread_ts == parent and msg.ts != parent):
+                old[msg.ts] = msg
+
+    added = [msg for key, msg in replies.items() if key not in old]
+    edited = []
+    for key, msg in replies.items():
+        if key not in old:
+            continue
+        msg_ori = old[key]
+        if msg_ori.edit != msg.get('edited', None):
+            edited.append(update_message(msg_ori, msg, conv_id))
+            continue
+        # reactions are not told apart by edits
+        insert_reactions(msg.get('reactions', []), 'message', msg['ts'], conv_id)
+        if msg_ori.thread_ts is None:
+            type(msg_ori).update(thread_ts=parent).where(type(msg_ori).id == msg_ori.id).execute()
+    deleted = [msg for key, msg in old.items() if key not in replies]
+
+    for msg in added:
+        prepare_message(msg, conv_id)
+    m.Message.api_bulk_insert(added)
+    for msg in deleted:
+        msg.delete_instance()
+
+    m.ChangeLog.record('message', 'insert', [m.Message.key(conv_id, msg['ts']) for msg in added])
+    m.ChangeLog.record('message', 'update', [m.Message.key(conv_id, msg.ts) for msg in edited])
+    m.ChangeLog.record('message', 'delete', [m.Message.key(conv_id, msg.ts) for msg in deleted])
+
+    return len(added)
+
+def save_message_diff(conv_id, msglist):
+    ''' Update messages edited since they were saved.
+        Returns updated messages and ts of threads having new replies. '''
     list_mod = []
-    has_more = True
-
-    result = (m.Message.select(m.Message.ts)
-        .where(m.Message.channel == channel)
-        .order_by(m.Message.ts.desc())
-        .first())
-
-    if result is None:
-        return None
-
-    # strange behavior
-    ts_latest = '{:.6f}'.format(float(result.ts) + 1) if result else None
-
-    with m.db.atomic():
-        while has_more:
-            resp = slack.channels.history(
-                latest=ts_latest,
-                count=1000,
-                channel=channel.id
-            ).body
-
-            msglist = resp['messages']
-
-            for msg in msglist:
-                # check for difference (status of edition).
-                msg_ori = (m.Message.select()
-                    .where(m.Message.channel == channel
-                        and m.Message.ts == msg['ts'])
-                    .first())
-                # check if they are exactly the same
-                # will msg_ori always exist?
-                if msg_ori and msg_ori.edit != msg.get('edited', None):
-                    # update, taking original id
-                    # FIXME: prevent duplicating objects
-                    msg['channel'] = channel
-                    process_message(msg)
-                    if 'reactions' in msg:
-                        insert_reactions(msg['reactions'], 'message', msg['ts'], channel)
-                    msg_new = m.Message.api(msg)
-                    msg_new.id = msg_ori.id
-                    msg_new.save()
-                    list_mod.append(msg_new)
-
-            if len(msglist):
-                # the list is always sorted by ts desc
-                ts_latest = msglist[-1]['ts']
-
-            has_more = resp['has_more']
-
-    return list_mod
-
-def fetch_all_channel_message():
+    threads = []
+    for msg in msglist:
+        # check for difference (status of edition).
+        msg_ori = m.Message.find(conv_id, msg['ts'])
+        # will msg_ori always exist?
+        if msg_ori is None:
+            continue
+        # only threads with new replies since the last run are fetched
+        thread_changed = (is_thread_parent(msg)
+            and latest_reply(msg) != latest_reply(msg_ori.raw or {}))
+        # check if they are exactly the same
+        if msg_ori.edit != msg.get('edited', None):
+            list_mod.append(update_message(msg_ori, msg, conv_id))
+        elif thread_changed:
+            list_mod.append(update_thread_parent(msg_ori, msg, conv_id))
+        if thread_changed:
+            threads.append(msg['ts'])
+    m.ChangeLog.record('message', 'update',
+        [m.Message.key(conv_id, msg.ts) for msg in list_mod])
+    return list_mod, threads
+
+class RateLimiter(object):
+    ''' Space out API calls made from all workers,
+        allowing at most `calls` calls every `period` seconds. '''
+    def __init__(self, calls, period=60):
+        self.interval = period / calls
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+limiter = RateLimiter(getattr(settings, 'rate_limit', 50))
+
+def api(method, **kwargs):
+    ''' Call a Slack API method, waiting for the rate limit. '''
+    limiter.wait()
+    return method(**kwargs).body
+
+# a request to be made by workers, whose response is passed to `handler`,
+#  or the error from Slack to `on_error` if given
+Job = namedtuple('Job', ['method', 'kwargs', 'handler', 'on_error'])
+Job.__new__.__defaults__ = (None,)
+
+def run_jobs(jobs, workers=None):
+    ''' Make API requests of jobs on a pool of workers.
+        Responses are handled on the calling thread only, so all writes happen
+        here, in one transaction per batch of finished requests.
+        A handler may return more jobs to run, e.g. the next page. '''
+    workers = workers or getattr(settings, 'workers', 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit(job):
+            pending[executor.submit(api, job.method, **job.kwargs)] = job
+
+        for job in jobs:
+            submit(job)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            # shards of messages to be saved cannot be attached within the transaction
+            m.router.prepare([msg['ts'] for future in done if future.exception() is None
+                              for msg in future.result().get('messages', [])])
+            with m.db.atomic():
+                for future in done:
+                    job = pending.pop(future)
+                    try:
+                        resp = future.result()
+                    except slacker.Error as err:
+                        if job.on_error is None:
+                            raise
+                        more = job.on_error(err)
+                    else:
+                        more = job.handler(resp)
+                    for next_job in more or []:
+                        submit(next_job)
+
+# types of conversations sharing the same way of fetching
+ConversationType = namedtuple('ConversationType', ['name', 'model', 'api', 'list_key'])
+
+CHANNEL = ConversationType('channel', m.Channel, slack.channels, 'channels')
+# private channels, multiparty direct messages included
+GROUP = ConversationType('group', m.Group, slack.groups, 'groups')
+IM = ConversationType('im', m.DirectMessage, slack.im, 'ims')
+
+CONVERSATION_TYPES = [CHANNEL, GROUP, IM]
+
+class ConversationSync(object):
+    ''' Jobs and progress of fetching messages of a single conversation.
+        History is fetched since a mark saved for each conversation, which is
+        only advanced once every job has finished without an error, so that
+        a run stopped halfway is picked up by the next one. '''
+    def __init__(self, kind, conv, on_finish=None):
+        self.kind = kind
+        self.conv = conv
+        self.on_finish = on_finish
+        self.cnt_add = 0
+        self.list_mod = []
+        self.ts_oldest = None
+        self.ts_newest = None
+        # parents of threads to be fetched after the history
+        self.threads = []
+        # number of history scans and unfinished jobs
+        self.scans = 0
+        self.pending = 0
+        # errors from Slack, leaving the conversation to the next run
+        self.errors = []
+
+    @property
+    def mark(self):
+        return '__history_{}'.format(self.conv.id)
+
+    def _history(self, handler, oldest=None, latest=1e10):
+        self.pending += 1
+        return Job(self.kind.api.history, {
+            'channel': self.conv.id,
+            'oldest': oldest,
+            'latest': latest,
+            'count': 1000
+        }, handler, self.on_history_error)
+
+    def _replies(self, thread_ts):
+        self.pending += 1
+        return Job(self.kind.api.replies, {
+            'channel': self.conv.id,
+            'thread_ts': thread_ts
+        }, lambda resp: self.on_replies(thread_ts, resp), self.on_replies_error)
+
+    def _next_page(self, handler, resp, oldest=None):
+        ''' Get jobs following a page of history. '''
+        msglist = resp['messages']
+        if resp['has_more'] and msglist:
+            # the list is always sorted by ts desc
+            return [self._history(handler, oldest=oldest, latest=msglist[-1]['ts'])]
+        return self._end_scan()
+
+    def _end_scan(self):
+        self.scans -= 1
+        if self.scans:
+            return []
+        threads, self.threads = self.threads, []
+        return [self._replies(thread_ts) for thread_ts in threads]
+
+    def _done(self, jobs):
+        ''' Count off a finished job, reporting when nothing is left. '''
+        self.pending -= 1
+        if self.pending == 0:
+            if not self.errors and self.ts_newest is not None:
+                m.Information.update(value=m.key_to_ts(self.ts_newest)).where(
+                    m.Information.key == self.mark).execute()
+            if self.on_finish:
+                self.on_finish(self)
+        return jobs
+
+    def start(self):
+        mark = m.Information.getBy('key', self.mark)
+        if mark is None:
+            # older versions saved all pages of a conversation at once
+            result = m.Message.latest(self.conv.id)
+            mark = m.Information.create(key=self.mark,
+                value=m.key_to_ts(result.ts) if result else None)
+
+        self.ts_oldest = mark.value
+        jobs = [self._history(self.on_history, oldest=self.ts_oldest)]
+        if self.ts_oldest is not None:
+            # exprimental: scan for edited messages as well
+            # strange behavior
+            ts_latest = m.key_to_ts(m.ts_to_key(self.ts_oldest) + 1000000)
+            jobs.append(self._history(self.on_diff, latest=ts_latest))
+        self.scans = len(jobs)
+        return jobs
+
+    def on_history(self, resp):
+        msglist = resp['messages']
+        if msglist:
+            newest = m.ts_to_key(msglist[0]['ts'])
+            self.ts_newest = max(newest, self.ts_newest or newest)
+        # pages saved by a run stopped halfway are fetched again
+        stored = m.Message.stored(self.conv.id, [msg['ts'] for msg in msglist])
+        msglist = [msg for msg in msglist if m.ts_to_key(msg['ts']) not in stored]
+        self.cnt_add += len(msglist)
+
+        for msg in resp['messages']:
+            if is_thread_parent(msg) and latest_reply(msg):
+                self.threads.append(msg['ts'])
+        for msg in msglist:
+            prepare_message(msg, self.conv.id)
+
+        m.Message.api_bulk_insert(msglist)
+        m.ChangeLog.record('message', 'insert',
+            [m.Message.key(self.conv.id, msg['ts']) for msg in msglist])
+        return self._done(self._next_page(self.on_history, resp, self.ts_oldest))
+
+    def on_diff(self, resp):
+        list_mod, threads = save_message_diff(self.conv.id, resp['messages'])
+        self.list_mod.extend(list_mod)
+        self.threads.extend(threads)
+        return self._done(self._next_page(self.on_diff, resp))
+
+    def on_replies(self, thread_ts, resp):
+        self.cnt_add += save_thread_replies(self.conv.id, thread_ts, resp['messages'])
+        return self._done([])
+
+    def on_history_error(self, err):
+        # pages left are fetched by the next run
+        self.errors.append(err)
+        return self._done(self._end_scan())
+
+    def on_replies_error(self, err):
+        self.errors.append(err)
+        return self._done([])
+
+def fetch_all_message(kinds=CONVERSATION_TYPES):
+    ''' Fetch messages of every conversation of given types at once. '''
     lst = []
-    for chan in m.Channel.select().iterator():
-        lst.append(chan)
+    for kind in kinds:
+        for conv in kind.model.select().iterator():
+            lst.append((kind, conv))
 
-    cnt_ttl_add = 0
-    cnt_ttl_mod = 0
-    cnt_ttl = 0
+    cnt_ttl = {'add': 0, 'mod': 0, 'len': 0, 'done': 0}
 
     _tmpl = '{:22.22}: +{:>4}, ~{:>4}, len={:>6}'
 
-    for i, chan in enumerate(lst):
-        print('{}% [ Fetching #{}... ]'.format(i * 100 // len(lst), chan.name), end='', flush=True)
-        with m.db.atomic():
-            cnt_add = fetch_channel_message(chan)
-            cnt_ttl_add += cnt_add
-            cnt_ttl += chan.length
-            # exprimental
-            list_mod = fetch_channel_message_diff(chan)
-            cnt_mod = len(list_mod)
-        print('\r' + _tmpl.format('#' + chan.name, cnt_add, cnt_mod, chan.length))
+    def report(sync):
+        length = sync.conv.length
+        cnt_ttl['add'] += sync.cnt_add
+        cnt_ttl['mod'] += len(sync.list_mod)
+        cnt_ttl['len'] += length
+        cnt_ttl['done'] += 1
+        print(_tmpl.format(sync.conv.label, sync.cnt_add, len(sync.list_mod), length),
+            '({}%)'.format(cnt_ttl['done'] * 100 // len(lst)))
+        if sync.errors:
+            print(' Warning: {} is not fetched completely, to be continued next time: {}'.format(
+                sync.conv.label, ', '.join(sorted(set(str(err) for err in sync.errors)))))
+
+    jobs = []
+    for kind, conv in lst:
+        jobs.extend(ConversationSync(kind, conv, report).start())
+    run_jobs(jobs)
 
     print()
-    print(_tmpl.format('--- TOTAL ---', cnt_ttl_add, cnt_ttl_mod, cnt_ttl))
+    print(_tmpl.format('--- TOTAL ---', cnt_ttl['add'], cnt_ttl['mod'], cnt_ttl['len']))
     print()
 
 def fetch_all_star_item():
@@ -299,15 +641,31 @@ def fetch_all_star_item():
     print()
 
 
-def init():
-    # modify the name of the database here
-    m.db.init('slack-archv-test.sqlite')
+def open_archive():
+    ''' Open the database, creating tables and attaching shards. '''
+    m.db.initialize(m.ArchiveDatabase(getattr(settings, 'database', 'slack-archv-test.sqlite')))
+    # let the server read while fetching
+    m.db.execute_sql('PRAGMA journal_mode = wal')
 
     with m.db.atomic():
         m.init_models()
         # Add version info
         m.Information.create_or_get(key='__version', value='1.0.0')
 
+    # optionally split messages and reactions into a database per year
+    if getattr(settings, 'shard_path', None):
+        m.router.setup(settings.shard_path, getattr(settings, 'shard_years', 1))
+
+def init():
+    open_archive()
+
+    # bring archives of older versions up to date;
+    # large ones may rather run `migrations.py` on their own
+    migrations.run(backfill=getattr(settings, 'migrate_on_start', True))
+
+    if m.router.enabled:
+        m.split_shards()
+
 def main():
     print('Fetching Authentication info...')
     auth_resp = assert_auth()
@@ -323,12 +681,26 @@ def main():
     fetch_user_list()
     print('Fetching Channel list...')
     fetch_channel_list()
+    kinds = [CHANNEL]
+    for kind, desc in [(GROUP, 'Private channel'), (IM, 'Direct message')]:
+        print('Fetching {} list...'.format(desc))
+        try:
+            fetch_conversation_list(kind)
+            kinds.append(kind)
+        except slacker.Error as err:
+            # the token may not be granted to read them
+            print(' Warning: {} list is skipped: {}'.format(desc, err))
     print('Fetching Emoji list...')
     fetch_emoji_list()
-    print('Fetching all messages from channels...')
-    fetch_all_channel_message()
+    print('Fetching all messages from conversations...')
+    fetch_all_message(kinds)
+    print('Fetching incomplete reactions...')
+    fetch_incomplete_reactions()
     # print('Fetching all starred items from users...')
     # fetch_all_star_item()
 
+    # tell readers, e.g. the server, that the archive has changed
+    m.Information.insert(key='__synced', value=datetime.datetime.now().isoformat()).upsert().execute()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+''' Load test of a local `server.py`.
+    Requests channel listings and pages of messages from a number of threads,
+    revalidating with ETags every few requests, and reports throughput
+    and latency percentiles.
+
+    usage: python benchmarks/loadtest_server.py [--url URL] [--threads N] [--seconds S] '''
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+def fetch(url, etag=None):
+    req = urllib.request.Request(url)
+    if etag:
+        req.add_header('If-None-Match', etag)
+    try:
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+            return resp.status, resp.headers.get('ETag')
+    except urllib.error.HTTPError as err:
+        return err.code, err.headers.get('ETag')
+
+def worker(base, paths, deadline, results):
+    etags = {}
+    rnd = random.Random()
+    while time.time() < deadline:
+        path = rnd.choice(paths)
+        # every third request revalidates, as browsers do
+        etag = etags.get(path) if rnd.random() < 1 / 3 else None
+        start = time.perf_counter()
+        status, etags[path] = fetch(base + path, etag)
+        results.append((path, status, time.perf_counter() - start))
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a local archive server.')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    with urllib.request.urlopen(args.url + '/channels') as resp:
+        channels = [chan['id'] for chan in json.loads(resp.read().decode())['channels']]
+
+    paths = ['/channels', '/users']
+    for chan_id in channels[:20]:
+        paths.append('/channels/' + chan_id)
+        paths.append('/channels/{}/messages?limit=100'.format(chan_id))
+        # streamed
+        paths.append('/channels/{}/messages?limit=1000'.format(chan_id))
+
+    results = []
+    deadline = time.time() + args.seconds
+    threads = [threading.Thread(target=worker, args=(args.url, paths, deadline, results))
+               for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('{} requests in {:.1f}s, {:.1f} req/s, {} threads'.format(
+        len(results), args.seconds, len(results) / args.seconds, args.threads))
+    statuses = {}
+    for _, status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print('status: ' + ', '.join('{}={}'.format(k, v) for k, v in sorted(statuses.items())))
+
+    _tmpl = '{:40.40} {:>7} {:>9} {:>9} {:>9}'
+    print(_tmpl.format('path', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    groups = {}
+    for path, _, elapsed in results:
+        kind = re.sub(r'^/channels/[A-Z0-9]+', '/channels/:id', path)
+        groups.setdefault(kind, []).append(elapsed)
+    for kind, values in sorted(groups.items()):
+        values.sort()
+        print(_tmpl.format(kind, len(values),
+            *['{:.1f}'.format(percentile(values, pct) * 1000) for pct in [50, 95, 99]]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+''' Compare ways of storing Slack ts in SQLite: as DATETIME (what older
+    archives do), as TEXT, and as integer microseconds (`TimestampField`).
+    Reports index size and speed of range queries.
+
+    usage: python benchmarks/ts_keys.py [ROWS] '''
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+CHANNELS = 50
+QUERIES = 2000
+# about five years of history
+TS_FROM = 1420070400
+TS_SPAN = 5 * 365 * 86400
+
+LAYOUTS = [
+    # (name, column type, value stored from a ts string, ts read back from a value)
+    ('datetime', 'DATETIME', lambda ts: ts, lambda value: '{:.6f}'.format(value)),
+    ('text', 'TEXT', lambda ts: ts, lambda value: value),
+    ('integer', 'BIGINT', lambda ts: int(ts.replace('.', '')),
+        lambda value: '{}.{:06d}'.format(value // 1000000, value % 1000000)),
+]
+
+def make_rows():
+    random.seed(0)
+    rows = []
+    for _ in range(ROWS):
+        sec = TS_FROM + random.randrange(TS_SPAN)
+        ts = '{}.{:06d}'.format(sec, random.randrange(1000000))
+        rows.append(('C{:08d}'.format(random.randrange(CHANNELS)), ts))
+    return rows
+
+def index_size(conn, name):
+    try:
+        return conn.execute('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (name,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        # without dbstat, measure the growth of the file instead
+        return None
+
+def page_bytes(conn):
+    return (conn.execute('PRAGMA page_count').fetchone()[0]
+            * conn.execute('PRAGMA page_size').fetchone()[0])
+
+def bench(name, coltype, conv, back, rows, windows):
+    path = os.path.join(tempfile.mkdtemp(), name + '.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE message (id INTEGER PRIMARY KEY, channel_id TEXT, ts {0}, '
+                 'thread_ts {0}, subtype TEXT)'.format(coltype))
+    conn.executemany('INSERT INTO message (channel_id, ts) VALUES (?, ?)',
+                     ((chan, conv(ts)) for chan, ts in rows))
+    conn.commit()
+
+    classes = dict(conn.execute('SELECT typeof(ts), COUNT(*) FROM message GROUP BY 1').fetchall())
+    stored = conn.execute('SELECT ts FROM message ORDER BY id')
+    lossy = sum(1 for (chan, ts), (value,) in zip(rows, stored) if back(value) != ts)
+
+    before = page_bytes(conn)
+    # the indexes `Message` declares
+    conn.execute('CREATE INDEX message_ts ON message (ts)')
+    conn.execute('CREATE INDEX message_channel_id ON message (channel_id)')
+    conn.execute('CREATE INDEX message_channel_id_thread_ts ON message (channel_id, thread_ts)')
+    conn.execute('CREATE INDEX message_channel_id_ts ON message (channel_id, ts)')
+    conn.commit()
+    size = index_size(conn, 'message_ts')
+    if size is None:
+        size = (page_bytes(conn) - before) // 4
+
+    # windows of a day, as the server and diff scans query them
+    start = time.perf_counter()
+    cnt = 0
+    for lo, hi in windows:
+        cnt += conn.execute('SELECT COUNT(*) FROM message WHERE ts >= ? AND ts < ?',
+                            (conv(lo), conv(hi))).fetchone()[0]
+    elapsed_range = time.perf_counter() - start
+
+    # the newest message of every channel, as `Message.latest` does
+    start = time.perf_counter()
+    for i in range(CHANNELS):
+        conn.execute('SELECT ts FROM message WHERE channel_id = ? AND (thread_ts IS NULL '
+                     'OR thread_ts = ts OR subtype = \'thread_broadcast\') '
+                     'ORDER BY ts DESC LIMIT 1', ('C{:08d}'.format(i),)).fetchone()
+    elapsed_latest = time.perf_counter() - start
+
+    conn.close()
+    os.remove(path)
+    return classes, lossy, size, elapsed_range, cnt, elapsed_latest
+
+def main():
+    rows = make_rows()
+    random.seed(1)
+    windows = []
+    for _ in range(QUERIES):
+        lo = TS_FROM + random.randrange(TS_SPAN)
+        windows.append(('{}.000000'.format(lo), '{}.000000'.format(lo + 86400)))
+
+    print('{} rows, {} range queries'.format(ROWS, QUERIES))
+    print('{:10} {:>22} {:>8} {:>12} {:>12} {:>10} {:>12}'.format(
+        'layout', 'storage classes', 'lossy', 'index (KiB)', 'range (ms)', 'matched', 'latest (ms)'))
+    for name, coltype, conv, back in LAYOUTS:
+        classes, lossy, size, elapsed_range, cnt, elapsed_latest = bench(
+            name, coltype, conv, back, rows, windows)
+        print('{:10} {:>22} {:>8} {:>12} {:>12.1f} {:>10} {:>12.2f}'.format(
+            name, ','.join('{}={}'.format(k, v) for k, v in sorted(classes.items())), lossy,
+            size // 1024, elapsed_range * 1000, cnt, elapsed_latest * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+''' Versioned migrations bringing archives of older versions up to date.
+
+    Schema changes are short statements applied to the main database and
+    every shard. Existing rows are then backfilled in chunks of primary keys,
+    a transaction each, saving a cursor along so that an interrupted run
+    resumes where it stopped and fetching can go on between chunks.
+
+    usage: python migrations.py [--chunk N] [--pause SECONDS] [--schema-only] '''
+
+import argparse
+import json
+import time
+
+from peewee import SqliteDatabase, fn
+from playhouse.migrate import SqliteMigrator, migrate
+
+import models as m
+
+class Migration(object):
+    ''' A version of the schema.
+        `schema` is a list of functions returning migration operations
+        still missing in a database. `backfill` is a list of pairs of a model
+        and a function converting its rows with primary keys in (lo, hi]. '''
+    def __init__(self, version, description, schema=None, backfill=None):
+        self.version = version
+        self.description = description
+        self.schema = schema or []
+        self.backfill = backfill or []
+
+def add_column(model, name):
+    def operations(database, migrator):
+        table = model._meta.db_table
+        if name in [col.name for col in database.get_columns(table)]:
+            return []
+        # indexes of the column are added along with it
+        return [migrator.add_column(table, name, model._meta.fields[name])]
+    return operations
+
+def add_index(model, columns):
+    ''' Note that SQLite builds an index in one statement; it cannot be chunked. '''
+    def operations(database, migrator):
+        table = model._meta.db_table
+        if '_'.join((table,) + columns) in [idx.name for idx in database.get_indexes(table)]:
+            return []
+        return [migrator.add_index(table, columns, False)]
+    return operations
+
+def copy_thread_ts(model, lo, hi):
+    ''' Set ts of threads, which older versions left in raw. '''
+    pk = model._meta.primary_key
+    rows = list(model.select(pk, model.raw)
+        .where((pk > lo) & (pk <= hi) & model.thread_ts.is_null()
+            & (fn.instr(model.raw, '"thread_ts"') > 0))
+        .tuples())
+    for row_id, raw in rows:
+        thread_ts = raw.pop('thread_ts')
+        model.update(thread_ts=thread_ts, raw=raw).where(pk == row_id).execute()
+
+def move_file_ids(model, lo, hi):
+    ''' Move ids of files out of the column for ts of messages. '''
+    pk = model._meta.primary_key
+    (model.update(item_file=model.item_id, item_id=0)
+        .where((pk > lo) & (pk <= hi)
+            & (model.item_type != 'message')
+            & model.item_file.is_null())
+        .execute())
+
+def convert_ts(*names):
+    ''' Convert ts stored as REAL, TEXT or whole seconds into integer keys. '''
+    def backfill(model, lo, hi):
+        pk = model._meta.primary_key
+        for name in names:
+            field = getattr(model, name)
+            # values are converted by the field upon selection
+            rows = list(model.select(pk, field)
+                .where((pk > lo) & (pk <= hi) & field.is_null(False)
+                    # see `ts_to_key` for integers taken as seconds
+                    & ((fn.typeof(field) != 'integer') | (field < 10 ** 11)))
+                .tuples())
+            for row_id, key in rows:
+                model.update(**{name: key}).where(pk == row_id).execute()
+    return backfill
+
+MIGRATIONS = [
+    Migration(1, 'threads of messages', schema=[
+        add_column(m.Message, 'thread_ts'),
+        add_index(m.Message, ('channel_id', 'thread_ts')),
+    ], backfill=[
+        (m.Message, copy_thread_ts),
+    ]),
+    Migration(2, 'files reacted to', schema=[
+        add_column(m.Reaction, 'item_file'),
+    ], backfill=[
+        (m.Reaction, move_file_ids),
+    ]),
+    Migration(3, 'integer ts keys', backfill=[
+        (m.Message, convert_ts('ts', 'thread_ts')),
+        (m.Reaction, convert_ts('item_id')),
+    ]),
+    Migration(4, 'index of history', schema=[
+        add_index(m.Message, ('channel_id', 'ts')),
+    ]),
+]
+
+def get_state(key, default=0):
+    info = m.Information.getBy('key', key)
+    return json.loads(info.value) if info else default
+
+def set_state(key, value):
+    m.Information.insert(key=key, value=json.dumps(value)).upsert().execute()
+
+def databases():
+    ''' Iterate over the main database and every shard, opened on its own. '''
+    yield m.db
+    for key in m.router.keys:
+        shard_db = SqliteDatabase(m.router.shard_path(key))
+        yield shard_db
+        shard_db.close()
+
+def apply_schema(verbose=True):
+    ''' Apply schema changes of all pending versions. '''
+    current = get_state('__schema_version')
+    for migration in MIGRATIONS:
+        if migration.version <= current or not migration.schema:
+            continue
+        if verbose:
+            print('Migrating schema to version {} ({})...'.format(
+                migration.version, migration.description))
+        for database in databases():
+            migrator = SqliteMigrator(database)
+            operations = [op for step in migration.schema for op in step(database, migrator)]
+            if operations:
+                with database.atomic():
+                    migrate(*operations)
+    set_state('__schema_version', MIGRATIONS[-1].version)
+
+def run_backfills(chunk=10000, pause=0, verbose=True):
+    ''' Backfill rows for all pending versions, resuming from the saved cursor. '''
+    current = get_state('__data_version')
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+
+        cursor = get_state('__migration_cursor', {})
+        if cursor.get('version', None) != migration.version:
+            cursor = {'version': migration.version, 'done': [], 'task': None, 'id': 0}
+
+        for idx, (base, backfill) in enumerate(migration.backfill):
+            for model in base.partitions():
+                task = '{}:{}:{}'.format(idx, model._meta.db_table, model._shard or 'main')
+                if task in cursor['done']:
+                    continue
+                pk = model._meta.primary_key
+                last_id = cursor['id'] if cursor['task'] == task else 0
+                # rows inserted from now on are in the new format already
+                max_id = model.select(fn.Max(pk)).scalar() or 0
+
+                while last_id < max_id:
+                    hi = min(last_id + chunk, max_id)
+                    with m.db.atomic():
+                        backfill(model, last_id, hi)
+                        cursor.update(task=task, id=hi)
+                        set_state('__migration_cursor', cursor)
+                    last_id = hi
+                    if verbose:
+                        print('\r{}% [ Migrating data to version {} ({}), {} ]'.format(
+                            last_id * 100 // max_id, migration.version,
+                            migration.description, task), end='', flush=True)
+                    if pause:
+                        # leave room for writers between chunks
+                        time.sleep(pause)
+
+                cursor['done'].append(task)
+                cursor.update(task=None, id=0)
+                set_state('__migration_cursor', cursor)
+                if verbose and max_id:
+                    print()
+
+        set_state('__data_version', migration.version)
+
+def run(backfill=True, chunk=10000, pause=0, verbose=True):
+    ''' Bring the archive up to date. Tables and shards must be set up already.
+        Without `backfill`, only the schema is changed; this is enough for
+        fetching, and rows can be converted later by running this module. '''
+    apply_schema(verbose)
+    if backfill:
+        run_backfills(chunk, pause, verbose)
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate an archive to the current version.')
+    parser.add_argument('--chunk', type=int, default=10000,
+                        help='number of rows per transaction')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to wait between chunks')
+    parser.add_argument('--schema-only', action='store_true',
+                        help='change the schema without converting rows')
+    args = parser.parse_args()
+
+    import archv
+    archv.open_archive()
+    run(not args.schema_only, args.chunk, args.pause)
+
+if __name__ == '__main__':
+    main()
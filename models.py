@@ -1,10 +1,23 @@
 import json
 import datetime
+import calendar
+import glob
 import re
 
 from peewee import *
 from playhouse.shortcuts import model_to_dict
-db = SqliteDatabase(None)
+
+class ArchiveDatabase(SqliteDatabase):
+    ''' Database attaching shards to every connection. '''
+    def initialize_connection(self, conn):
+        # pooled connections may have them attached already
+        attached = [row[1] for row in conn.execute('PRAGMA database_list')]
+        for key in router.keys:
+            if router.schema(key) not in attached:
+                conn.execute(router.attach_sql(key), (router.shard_path(key),))
+
+# initialized with an `ArchiveDatabase`, which the server replaces with a pooled one
+db = Proxy()
 
 def copy_keys(a, b, args):
     for key in args:
@@ -35,9 +48,45 @@ class JSONField(TextField):
             return None
         return json.loads(value)
 
-# class TimestampField(DateTimeField):
-#     '''Field for ts; only for setting format'''
-#     formats = '%Y-%m-%d %H:%M:%S.%f'
+def ts_to_key(ts):
+    ''' Convert a Slack ts like '1476123456.000100' into exact integer microseconds.
+        Floats are rounded. Integers are taken as converted, unless they are
+        small enough to be seconds, as whole ts are stored in older archives. '''
+    if isinstance(ts, int):
+        return ts if ts >= 10 ** 11 else ts * 1000000
+    if isinstance(ts, float):
+        return int(round(ts * 1000000))
+    sec, _, frac = ts.partition('.')
+    return int(sec) * 1000000 + int((frac + '000000')[:6])
+
+def key_to_ts(key):
+    ''' Convert integer microseconds back into a Slack ts. '''
+    return '{}.{:06d}'.format(key // 1000000, key % 1000000)
+
+class TimestampField(BigIntegerField):
+    ''' Field for ts, stored as integer microseconds.
+        Accepts anything `ts_to_key` does, including values in older archives. '''
+    def db_value(self, value):
+        return None if value is None else ts_to_key(value)
+
+    def python_value(self, value):
+        try:
+            return None if value is None else ts_to_key(value)
+        except ValueError:
+            # ids of files reacted to, stored along ts in older archives
+            return value
+
+def match_ts(field, ts_list):
+    ''' Condition of a ts field being any of `ts_list`. Rows of older archives
+        storing seconds are matched by the second until `migrations.py` has
+        converted them, so compare the values read back for exact ones. '''
+    keys = [ts_to_key(ts) for ts in ts_list]
+    if not keys:
+        return field << []
+    # bypass conversion by the field to compare with seconds
+    seconds = ((field >= SQL('?', min(keys) // 1000000))
+               & (field < SQL('?', max(keys) // 1000000 + 1)))
+    return (field << keys) | seconds
 
 class ModelBase(Model):
     ''' Super class for basic models '''
@@ -98,6 +147,41 @@ class ModelBase(Model):
     class Meta:
         database = db
 
+class ModelSharded(ModelBase):
+    ''' Super class for models whose rows can be split into shards by ts.
+        See `ShardRouter` for the layout. Subclasses define classmethods
+        `shard_ts(row)`, getting ts deciding the shard of a row to insert
+        or None for the main table, and `shard_column()`, getting the field
+        of that ts. '''
+    # key of the shard for models derived by the router
+    _shard = None
+
+    @classmethod
+    def shard_where(cls):
+        ''' Condition of rows in the main table which belong to shards. '''
+        return cls.shard_column().is_null(False)
+
+    @classmethod
+    def api_bulk_insert(cls, rows):
+        ''' Same as `ModelBase.api_bulk_insert`, sending rows to their shards.
+            Rows go to the main table if their shard is not attached. '''
+        if not router.enabled or cls._shard is not None:
+            return super().api_bulk_insert(rows)
+        groups = {}
+        for row in rows:
+            model = router.route(cls, cls.shard_ts(row))[0]
+            groups.setdefault(model, []).append(row)
+        for model, part in groups.items():
+            super(ModelSharded, model).api_bulk_insert(part)
+
+    @classmethod
+    def route(cls, ts):
+        return router.route(cls, ts)
+
+    @classmethod
+    def partitions(cls, since=None, reverse=False):
+        return router.partitions(cls, since, reverse)
+
 class Information(ModelBase):
     ''' As a hash map of team information and metadata '''
     key = CharField(primary_key=True)
@@ -266,15 +350,38 @@ class Attachment(ModelBase):
         del_keys(raw, cls.INTACT_KEYS + cls.REMOVED_KEYS)
         return attachment
 
-class DirectMessage(ModelBase):
+class ModelSlackConversation(ModelBase):
+    '''as a super class of anything messages are sent to'''
+    @property
+    def length(self):
+        return sum(model.select().where(model.channel == self.id).count()
+                   for model in Message.partitions())
+
+class DirectMessage(ModelSlackConversation):
     id = CharField(primary_key=True)
     user = ForeignKeyField(User, unique=True)
     # created = DateTimeField()
     user_deleted = BooleanField(null=True)
+
+    @property
+    def label(self):
+        try:
+            return '@' + self.user.name
+        except User.DoesNotExist:
+            return '@' + self.id
+
+    @classmethod
+    def _transform(cls, resp):
+        return {
+            'id': resp['id'],
+            'user': resp['user'],
+            'user_deleted': resp.get('is_user_deleted', None)
+        }
+
     class Meta:
         db_table = 'directMessage'
 
-class ModelSlackMessageList(ModelBase):
+class ModelSlackMessageList(ModelSlackConversation):
     '''as a super class of channels and groups'''
     name = CharField(unique=True)
     created = DateTimeField()
@@ -288,10 +395,14 @@ class ModelSlackMessageList(ModelBase):
     def members(self):
         return self.__class__.select().join(ChannelUser).where(ChannelUser.channel == self)
 
+    @property
+    def label(self):
+        return '#' + self.name
+
     @classmethod
     def _transform(cls, resp):
         msglist = {
-            'archived': resp['is_archived']
+            'archived': resp.get('is_archived', None)
         }
         return copy_keys(msglist, resp, ['id', 'name', 'created', 'creator', 'topic', 'purpose'])
 
@@ -301,10 +412,6 @@ class Channel(ModelSlackMessageList):
 
     INTACT_KEYS = ['id', 'name', 'created', 'creator', 'topic', 'purpose']
 
-    @property
-    def length(self):
-        return Message.select().where(Message.channel == self).count()
-
     @classmethod
     def _transform(cls, resp):
         msglist = {
@@ -315,13 +422,17 @@ class Channel(ModelSlackMessageList):
 class Group(ModelSlackMessageList):
     id = SlackIDField(primary_key=True)
 
-class Message(ModelBase):
-    channel = ForeignKeyField(Channel)
+class Message(ModelSharded):
+    # id of the conversation, which is a channel, group or direct message
+    channel = SlackIDField(db_column='channel_id', index=True)
     # if null, message is the real message of a user
     #  otherwise it should be only a hint describing raw
     subtype = CharField(null=True)
     text = TextField(null=True)
-    ts = DateTimeField(index=True)
+    ts = TimestampField(index=True)
+    # ts of the parent message if the message belongs to a thread,
+    #  the parent itself included
+    thread_ts = TimestampField(null=True)
     user = ForeignKeyField(User, null=True)
     file = ForeignKeyField(File, null=True)
     attachment = ForeignKeyField(Attachment, null=True)
@@ -329,7 +440,7 @@ class Message(ModelBase):
     raw = JSONField(null=True)
     updated = DateTimeField(default=datetime.datetime.now)
 
-    INTACT_KEYS = ['channel', 'subtype', 'text', 'ts', 'user']
+    INTACT_KEYS = ['channel', 'subtype', 'text', 'ts', 'thread_ts', 'user']
     REMOVED_KEYS = INTACT_KEYS + [
         'type', 'edited', '_attachment', '_file', 'is_starred',
         'comment'
@@ -380,6 +491,93 @@ class Message(ModelBase):
         # todo: comment
         return message
 
+    @staticmethod
+    def key(channel, ts):
+        ''' Identify a message across tables, in the same format as starred ones. '''
+        return '{}/{}'.format(channel, key_to_ts(ts_to_key(ts)))
+
+    @classmethod
+    def shard_ts(cls, row):
+        return row['ts']
+
+    @classmethod
+    def shard_column(cls):
+        return cls.ts
+
+    @classmethod
+    def find(cls, channel, ts):
+        ''' Get a message by its channel and ts. '''
+        key = ts_to_key(ts)
+        for model in cls.route(ts):
+            for msg in model.select().where((model.channel == channel) & match_ts(model.ts, [key])):
+                if msg.ts == key:
+                    return msg
+        return None
+
+    @classmethod
+    def stored(cls, channel, ts_list):
+        ''' Get keys of the messages of a channel among `ts_list` already stored. '''
+        keys = {ts_to_key(ts) for ts in ts_list}
+        found = set()
+        for model in cls.partitions(since=min(keys)) if keys else []:
+            found.update(ts for ts, in model.select(model.ts)
+                .where((model.channel == channel) & match_ts(model.ts, keys))
+                .tuples())
+        return found & keys
+
+    @classmethod
+    def top_level(cls):
+        ''' Condition of messages shown in the channel, not only in their thread. '''
+        return (cls.thread_ts.is_null()
+            | (cls.thread_ts == cls.ts)
+            | (cls.subtype == 'thread_broadcast'))
+
+    @classmethod
+    def latest(cls, channel):
+        ''' Get the newest message of a channel, looking at newer shards first.
+            Replies are left out, as history does not return them. '''
+        for model in cls.partitions(reverse=True):
+            msg = (model.select()
+                .where((model.channel == channel) & model.top_level())
+                .order_by(model.ts.desc())
+                .first())
+            if msg is not None:
+                return msg
+        return None
+
+    @classmethod
+    def history(cls, channel, before=None, limit=100):
+        ''' Iterate over messages of a channel older than `before`, newest first.
+            Replies are left to their threads unless also sent to the channel. '''
+        for model in cls.partitions(reverse=True):
+            if limit <= 0:
+                break
+            query = model.select().where((model.channel == channel) & model.top_level())
+            if before is not None:
+                query = query.where(model.ts < before)
+            for msg in query.order_by(model.ts.desc()).limit(limit).iterator():
+                limit -= 1
+                yield msg
+
+    @classmethod
+    def thread(cls, channel, thread_ts):
+        ''' Get all messages of a thread, the parent first. '''
+        messages = []
+        # replies are never older than the parent
+        for model in cls.partitions(since=thread_ts):
+            messages.extend(model.select()
+                .where((model.channel == channel) & (model.thread_ts == thread_ts))
+                .order_by(model.ts))
+        return sorted(messages, key=lambda msg: msg.ts)
+
+    class Meta:
+        indexes = (
+            # for reading a whole thread back in one query
+            (('channel', 'thread_ts'), False),
+            # for pages of history, newest first
+            (('channel', 'ts'), False),
+        )
+
 class ChannelUser(ModelBase):
     channel = ForeignKeyField(Channel)
     user = ForeignKeyField(User)
@@ -434,13 +632,116 @@ class StarPrivate(ModelSlackStarList):
         db_table = 'starPrivate'
 
 # Experimental feature on Slack
-class Reaction(ModelBase):
+class Reaction(ModelSharded):
     item_type = CharField(null=True)
-    item_id = DateTimeField(index=True)
-    channel = ForeignKeyField(Channel, null=True)
+    # ts of the message, 0 for files and file comments
+    #  as the column is NOT NULL in older archives
+    item_id = TimestampField(index=True)
+    # id of the file or file comment
+    item_file = SlackIDField(null=True, index=True)
+    # id of the conversation of a message
+    channel = SlackIDField(db_column='channel_id', null=True)
     reaction = CharField()
     user = ForeignKeyField(User)
 
+    @staticmethod
+    def item_fields(item_type, item_id):
+        ''' Map id of an item to the field it is stored in. '''
+        if item_type == 'message':
+            return {'item_id': item_id, 'item_file': None}
+        return {'item_id': 0, 'item_file': item_id}
+
+    @classmethod
+    def shard_ts(cls, row):
+        # only reactions of messages have ts as item_id
+        return row['item_id'] if row.get('item_type', None) == 'message' else None
+
+    @classmethod
+    def shard_column(cls):
+        return cls.item_id
+
+    @classmethod
+    def shard_where(cls):
+        return cls.item_type == 'message'
+
+class IncompleteReaction(ModelBase):
+    ''' Queue of items whose reactions are stored truncated, to be fetched
+        in full after messages. Kept across runs until they are. '''
+    # item type, id and conversation as JSON; see `key`
+    id = CharField(primary_key=True)
+    # pairs of reaction and user stored before the truncated ones,
+    #  as the difference is logged only once complete
+    old = JSONField(null=True)
+    truncated = JSONField(null=True)
+
+    @staticmethod
+    def key(item_type, item_id, channel=None):
+        if item_type == 'message':
+            item_id = key_to_ts(ts_to_key(item_id))
+        return json.dumps([item_type, item_id, channel])
+
+    @property
+    def item(self):
+        return tuple(json.loads(self.id))
+
+    @property
+    def pairs(self):
+        ''' Get pairs stored before and the truncated ones as sets. '''
+        return ({tuple(pair) for pair in self.old or []},
+                {tuple(pair) for pair in self.truncated or []})
+
+    class Meta:
+        db_table = 'incompleteReaction'
+
+class ChangeLog(ModelBase):
+    ''' Append-only log of messages, files, reactions and users
+        inserted, updated or deleted by fetching.
+        Rows are never deleted, so seq keeps growing. '''
+    seq = PrimaryKeyField()
+    # message, file, reaction or user
+    entity = CharField()
+    entity_id = CharField()
+    # insert, update or delete
+    op = CharField()
+    created = DateTimeField(default=datetime.datetime.now)
+
+    @classmethod
+    def record(cls, entity, op, entity_ids):
+        cls.api_bulk_insert([
+            {'entity': entity, 'entity_id': eid, 'op': op} for eid in entity_ids
+        ])
+
+    @classmethod
+    def since(cls, seq=0, limit=1000):
+        ''' Get changes after seq, in order. '''
+        return cls.select().where(cls.seq > seq).order_by(cls.seq).limit(limit)
+
+    @classmethod
+    def read(cls, consumer, limit=1000):
+        ''' Get changes a consumer has not acknowledged yet. '''
+        offset = ChangeOffset.getBy('consumer', consumer)
+        return list(cls.since(offset.seq if offset else 0, limit))
+
+    @classmethod
+    def ack(cls, consumer, seq):
+        ''' Save the offset of a consumer after handling changes up to seq. '''
+        with db.atomic():
+            offset, created = ChangeOffset.get_or_create(consumer=consumer, defaults={'seq': seq})
+            if not created:
+                offset.seq = seq
+                offset.save()
+
+    class Meta:
+        db_table = 'changeLog'
+
+class ChangeOffset(ModelBase):
+    ''' Offsets in the change log saved by downstream consumers '''
+    consumer = CharField(primary_key=True)
+    seq = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'changeOffset'
+
 class Emoji(ModelBase):
     emoji = CharField(unique=True)
     url = TextField()
@@ -453,6 +754,174 @@ class Emoji(ModelBase):
             'url': cls.remove_permalink_domain(resp[1])
         }
 
+class ShardRouter(object):
+    ''' Optional layout splitting messages and their reactions by time
+        into databases attached to the main one, one for every `span` years.
+        Other tables stay in the main database, as do rows stored before
+        the layout is enabled until they are moved by `split()`. '''
+    # unless SQLite is built with another limit
+    MAX_ATTACHED = 10
+    # derived models, shared by all routers as peewee registers backrefs by name
+    models = {}
+
+    def __init__(self):
+        self.path = None
+        self.span = 1
+        # keys of attached shards, which are their first years
+        self.keys = []
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def setup(self, path, span=1):
+        ''' Enable shards stored at `path`, a pattern containing `{year}`,
+            attaching those already created. '''
+        self.path = path
+        self.span = span
+        prefix, suffix = path.split('{year}')
+        keys = [int(name[len(prefix):len(name) - len(suffix)])
+                for name in glob.glob(path.format(year='[0-9]' * 4))]
+        keys = [key for key in keys if key % span == 0]
+        self._check(len(keys))
+        for key in keys:
+            self._attach(key)
+
+    def shard_path(self, key):
+        return self.path.format(year=key)
+
+    def schema(self, key):
+        return 'shard_{}'.format(key)
+
+    def attach_sql(self, key):
+        return 'ATTACH DATABASE ? AS "{}"'.format(self.schema(key))
+
+    def shard_key(self, ts):
+        year = datetime.datetime.utcfromtimestamp(ts_to_key(ts) // 1000000).year
+        return year - year % self.span
+
+    def bounds(self, key):
+        ''' Get the range of ts keys stored in a shard. '''
+        return (calendar.timegm((key, 1, 1, 0, 0, 0)) * 1000000,
+                calendar.timegm((key + self.span, 1, 1, 0, 0, 0)) * 1000000)
+
+    def prepare(self, ts_list):
+        ''' Create and attach shards of rows to be written, if missing.
+            SQLite refuses to attach databases in a transaction,
+            so this is to be called before one begins. '''
+        if not self.enabled:
+            return
+        keys = sorted({self.shard_key(ts) for ts in ts_list} - set(self.keys))
+        self._check(len(self.keys) + len(keys))
+        for key in keys:
+            self._create(key)
+            self._attach(key)
+
+    def _check(self, count):
+        if count > self.MAX_ATTACHED:
+            raise RuntimeError('{} shards are needed, but SQLite attaches at most {} databases; '
+                               'set a larger `shard_years`'.format(count, self.MAX_ATTACHED))
+
+    def _derive(self, base, key, attached):
+        options = {'db_table': base._meta.db_table}
+        if attached:
+            options['schema'] = self.schema(key)
+        # distinct names keep backrefs of foreign keys apart
+        name = '{}Shard{}{}'.format(base.__name__, key, '' if attached else 'File')
+        return type(name, (base,), {
+            'Meta': type('Meta', (), options),
+            '__module__': __name__,
+            '_shard': key
+        })
+
+    def _create(self, key):
+        shard_db = SqliteDatabase(self.shard_path(key))
+        models = [self.model(base, key, attached=False) for base in SHARDED_MODELS]
+        # the connection is closed along with the context
+        with Using(shard_db, models):
+            shard_db.create_tables(models, safe=True)
+
+    def _attach(self, key):
+        self.keys.append(key)
+        self.keys.sort()
+        if not db.is_closed():
+            db.execute_sql(self.attach_sql(key), (self.shard_path(key),))
+
+    def model(self, base, key, attached=True):
+        ''' Get the model of a base model in a shard, either attached
+            or, for creating tables, in the shard file on its own. '''
+        if (base, key, attached) not in self.models:
+            self.models[(base, key, attached)] = self._derive(base, key, attached)
+        return self.models[(base, key, attached)]
+
+    def route(self, base, ts):
+        ''' Get models possibly storing a row of ts, the main one last. '''
+        if not self.enabled or ts is None:
+            return [base]
+        key = self.shard_key(ts)
+        return ([self.model(base, key)] if key in self.keys else []) + [base]
+
+    def partitions(self, base, since=None, reverse=False):
+        ''' Get all models storing rows of a base model, older first,
+            leaving out shards older than `since` if given. '''
+        keys = [key for key in self.keys
+                if since is None or self.bounds(key)[1] > ts_to_key(since)]
+        models = [base] + [self.model(base, key) for key in keys]
+        return models[::-1] if reverse else models
+
+    def split(self, base, chunk=10000):
+        ''' Move rows of the main table into shards, a chunk at a time.
+            Attached databases are not committed atomically in WAL mode, so
+            each chunk is copied and deleted in transactions of their own,
+            saving the last id of the shard before copying. A chunk copied
+            but not deleted before a crash is taken back by the next run,
+            which is safe as nothing else is written to shards meanwhile. '''
+        column = base.shard_column()
+        where = base.shard_where()
+        fields = [f for f in base._meta.sorted_fields if not f.primary_key]
+        state = '__split_{}'.format(base._meta.db_table)
+        info = Information.getBy('key', state)
+        if info is not None:
+            key, last_id = json.loads(info.value)
+            if key in self.keys:
+                shard = self.model(base, key)
+                shard.delete().where(shard._meta.primary_key > last_id).execute()
+            info.delete_instance()
+
+        cnt = 0
+        ts_hi = 0
+        while True:
+            # shards are created for years having rows only
+            ts_from = base.select(fn.Min(column)).where(where & (column >= ts_hi)).scalar()
+            if ts_from is None:
+                return cnt
+            key = self.shard_key(ts_from)
+            self.prepare([ts_from])
+            shard = self.model(base, key)
+            ts_lo, ts_hi = self.bounds(key)
+            while True:
+                ids = [row[0] for row in (base.select(base._meta.primary_key)
+                    .where(where & (column >= ts_lo) & (column < ts_hi))
+                    .limit(chunk).tuples())]
+                if not ids:
+                    break
+                last_id = shard.select(fn.Max(shard._meta.primary_key)).scalar() or 0
+                Information.insert(key=state, value=json.dumps([key, last_id])).upsert().execute()
+                shard.insert_from(
+                    [getattr(shard, f.name) for f in fields],
+                    base.select(*fields).where(base._meta.primary_key << ids)
+                ).execute()
+                with db.atomic():
+                    base.delete().where(base._meta.primary_key << ids).execute()
+                    Information.delete().where(Information.key == state).execute()
+                cnt += len(ids)
+
+router = ShardRouter()
+
+def split_shards():
+    ''' Move messages and reactions stored before shards were enabled into shards. '''
+    return sum(router.split(model) for model in SHARDED_MODELS)
+
 def init_models():
     ''' Create tables by model definitions. '''
     with db.atomic():
@@ -462,17 +931,22 @@ def init_models():
             Message,
             File,
             Attachment,
-            # DirectMessage,
+            DirectMessage,
             Channel,
-            # Group,
+            Group,
             ChannelUser,
             Star,
             # StarPrivate,
             FileComment,
             Reaction,
-            Emoji
+            IncompleteReaction,
+            Emoji,
+            ChangeLog,
+            ChangeOffset
         ], safe=True)
 
+SHARDED_MODELS = [Message, Reaction]
+
 def table_clean():
     ''' Remove all temporary data to allow full update. '''
     with db.atomic():
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+''' Read-only HTTP API over the archive.
+
+    Connections are pooled and read only, so the server keeps serving while
+    `archv.py` writes (the archive is in WAL mode). Responses are cached
+    until a sync completes, come with ETags, and large pages of messages
+    are streamed. Shards created after the server starts need a restart.
+
+    usage: python server.py [--host HOST] [--port PORT] '''
+
+import argparse
+import hashlib
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+from playhouse.pool import PooledDatabase
+
+import models as m
+
+# pages of messages larger than this are streamed instead of cached
+STREAM_LIMIT = 200
+MAX_LIMIT = 1000
+
+class ReadOnlyDatabase(PooledDatabase, m.ArchiveDatabase):
+    ''' Pool of connections refusing to write. '''
+    def initialize_connection(self, conn):
+        super().initialize_connection(conn)
+        conn.execute('PRAGMA query_only = 1')
+
+class ResponseCache(object):
+    ''' LRU cache of response bodies, each kept for at most `ttl` seconds. '''
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            body, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.entries[key] = (body, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SyncWatcher(object):
+    ''' Clear the cache once a sync has completed, checking at most every `interval` seconds. '''
+    def __init__(self, cache, interval=1):
+        self.cache = cache
+        self.interval = interval
+        self.synced = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def marker(self):
+        with self.lock:
+            if time.monotonic() - self.checked >= self.interval:
+                info = m.Information.getBy('key', '__synced')
+                synced = info.value if info else ''
+                if synced != self.synced:
+                    self.cache.clear()
+                    self.synced = synced
+                self.checked = time.monotonic()
+            return self.synced
+
+class NotFound(Exception):
+    pass
+
+class Stream(object):
+    ''' A response written in pieces as they are generated. '''
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+def dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+def message_json(msg):
+    message = msg._dict(merge_raw=True)
+    for key in ['ts', 'thread_ts']:
+        if key in message:
+            # rows not migrated yet may still have thread_ts in raw
+            message[key] = m.key_to_ts(m.ts_to_key(message[key]))
+    return message
+
+def channel_json(chan):
+    channel = chan._dict()
+    channel['length'] = chan.length
+    return channel
+
+def get_channel(chan_id):
+    chan = m.Channel.getBy('id', chan_id)
+    if chan is None:
+        raise NotFound()
+    return chan
+
+def list_channels(query):
+    return {'channels': [channel_json(chan) for chan in m.Channel.select().order_by(m.Channel.name)]}
+
+def show_channel(query, chan_id):
+    return {'channel': channel_json(get_channel(chan_id))}
+
+def list_users(query):
+    return {'users': [usr._dict(exclude=[m.User.raw]) for usr in m.User.select().order_by(m.User.name)]}
+
+def list_messages(query, chan_id):
+    get_channel(chan_id)
+    before = query.get('before', [None])[0]
+    if before is not None:
+        before = m.ts_to_key(before)
+    limit = min(int(query.get('limit', [100])[0]), MAX_LIMIT)
+    messages = m.Message.history(chan_id, before, limit)
+
+    if limit <= STREAM_LIMIT:
+        return {'messages': [message_json(msg) for msg in messages]}
+
+    def pieces():
+        yield '{"messages": ['
+        for idx, msg in enumerate(messages):
+            yield (',' if idx else '') + dumps(message_json(msg))
+        yield ']}'
+    return Stream(pieces())
+
+def show_thread(query, chan_id, thread_ts):
+    get_channel(chan_id)
+    messages = m.Message.thread(chan_id, thread_ts)
+    if not messages:
+        raise NotFound()
+    return {'messages': [message_json(msg) for msg in messages]}
+
+ROUTES = [
+    (re.compile(r'^/channels$'), list_channels),
+    (re.compile(r'^/channels/([A-Z0-9]+)$'), show_channel),
+    (re.compile(r'^/channels/([A-Z0-9]+)/messages$'), list_messages),
+    (re.compile(r'^/channels/([A-Z0-9]+)/threads/([0-9]+\.[0-9]+)$'), show_thread),
+    (re.compile(r'^/users$'), list_users),
+]
+
+cache = ResponseCache()
+watcher = SyncWatcher(cache)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        for rex, view in ROUTES:
+            match = rex.match(url.path)
+            if match:
+                break
+        else:
+            return self.send_error(404)
+
+        m.db.connect()
+        try:
+            # data only changes with syncs, so does the tag
+            etag = 'W/"{}"'.format(hashlib.sha1(
+                (watcher.marker() + self.path).encode()).hexdigest()[:20])
+            if self.headers.get('If-None-Match', None) == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+
+            body = cache.get(self.path)
+            if body is None:
+                try:
+                    resp = view(parse_qs(url.query), *match.groups())
+                except NotFound:
+                    return self.send_error(404)
+                except ValueError:
+                    return self.send_error(400)
+                if isinstance(resp, Stream):
+                    return self.send_stream(etag, resp)
+                body = dumps(resp).encode()
+                cache.put(self.path, body)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            m.db.close()
+
+    def send_stream(self, etag, stream):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        for piece in stream.pieces:
+            data = piece.encode()
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode() + data + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def main():
+    import settings
+
+    parser = argparse.ArgumentParser(description='Serve the archive read only.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--connections', type=int, default=16,
+                        help='maximum number of pooled connections')
+    args = parser.parse_args()
+
+    m.db.initialize(ReadOnlyDatabase(
+        getattr(settings, 'database', 'slack-archv-test.sqlite'),
+        max_connections=args.connections,
+        # pooled connections are passed between threads
+        check_same_thread=False
+    ))
+    if getattr(settings, 'shard_path', None):
+        m.router.setup(settings.shard_path, getattr(settings, 'shard_years', 1))
+
+    print('Serving on http://{}:{}/ ...'.format(args.host, args.port))
+    Server((args.host, args.port), Handler).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import copy
+import sys
+import types
+
+import pytest
+import slacker
+
+# archv reads its settings upon import
+settings = types.ModuleType('settings')
+settings.token = 'xoxp-test'
+settings.database = 'slack-archv-test.sqlite'
+settings.migrate_on_start = True
+settings.workers = 2
+settings.rate_limit = 1000000
+sys.modules['settings'] = settings
+
+import models as m
+import archv
+import migrations
+
+def message(ts, text='hi', **fields):
+    return dict({'type': 'message', 'user': 'U1', 'text': text, 'ts': ts}, **fields)
+
+def create_channel(chan_id='C1', name='general'):
+    return m.Channel.create(id=chan_id, name=name, created=0, creator='U1',
+                            topic={'value': ''}, purpose={'value': ''})
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = dict(body, ok=True)
+
+class FakeConversations(object):
+    ''' Methods of `channels`, `groups` or `im`, paging by `page_size`. '''
+    def __init__(self, slack, list_key):
+        self.slack = slack
+        self.list_key = list_key
+
+    def list(self, **kwargs):
+        return FakeResponse({self.list_key: copy.deepcopy(self.slack.conversations)})
+
+    def history(self, channel, latest=None, oldest=None, count=100, **kwargs):
+        self.slack.call('history', channel, oldest, latest)
+        msglist = [msg for msg in self.slack.messages.get(channel, [])
+                   if (oldest is None or m.ts_to_key(msg['ts']) > m.ts_to_key(oldest))
+                   and (latest is None or m.ts_to_key(msg['ts']) < m.ts_to_key(latest))]
+        msglist.sort(key=lambda msg: m.ts_to_key(msg['ts']), reverse=True)
+        page = msglist[:self.slack.page_size]
+        return FakeResponse({
+            'messages': copy.deepcopy(page),
+            'has_more': len(msglist) > len(page)
+        })
+
+    def replies(self, channel, thread_ts, **kwargs):
+        self.slack.call('replies', channel, thread_ts)
+        return FakeResponse({'messages': copy.deepcopy(self.slack.replies[(channel, thread_ts)])})
+
+class FakeReactions(object):
+    def __init__(self, slack):
+        self.slack = slack
+
+    def get(self, file_=None, file_comment=None, channel=None, timestamp=None, full=None):
+        self.slack.call('reactions', file_ or file_comment or timestamp)
+        if timestamp is not None:
+            item_type, key = 'message', (channel, timestamp)
+        else:
+            item_type, key = ('file', file_) if file_ else ('comment', file_comment)
+        if key not in self.slack.full_reactions:
+            raise slacker.Error('{}_not_found'.format(item_type))
+        return FakeResponse({item_type: {'reactions': copy.deepcopy(self.slack.full_reactions[key])}})
+
+class FakeSlack(object):
+    ''' Just enough of the Web API for fetching messages.
+        `messages` maps channels to messages shown in their history,
+        `replies` maps (channel, thread_ts) to threads, the parent first,
+        and `full_reactions` maps (channel, ts) or ids of files to reactions.
+        Calls in `failures` fail once. '''
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+        self.conversations = []
+        self.messages = {}
+        self.replies = {}
+        self.full_reactions = {}
+        self.calls = []
+        self.failures = set()
+        self.channels = FakeConversations(self, 'channels')
+        self.reactions = FakeReactions(self)
+
+    def call(self, *call):
+        self.calls.append(call)
+        if call in self.failures:
+            self.failures.remove(call)
+            raise slacker.Error('internal_error')
+
+@pytest.fixture
+def slack(monkeypatch):
+    fake = FakeSlack()
+    monkeypatch.setattr(archv, 'slack', fake)
+    monkeypatch.setattr(archv, 'CHANNEL', archv.CHANNEL._replace(api=fake.channels))
+    return fake
+
+@pytest.fixture
+def archive(tmpdir, monkeypatch):
+    ''' An empty archive of the current version in a temporary file. '''
+    monkeypatch.setattr(settings, 'database', str(tmpdir.join('archive.sqlite')))
+    monkeypatch.setattr(m, 'router', m.ShardRouter())
+    archv.open_archive()
+    migrations.run(verbose=False)
+    yield tmpdir
+    m.db.close()
@@ -0,0 +1,23 @@
+import models as m
+
+def test_read_and_ack(archive):
+    m.ChangeLog.record('message', 'insert', ['C1/1476123456.000100', 'C1/1476123457.000100'])
+    m.ChangeLog.record('user', 'update', ['U1'])
+
+    changes = m.ChangeLog.read('indexer')
+    assert [(log.entity, log.op, log.entity_id) for log in changes] == [
+        ('message', 'insert', 'C1/1476123456.000100'),
+        ('message', 'insert', 'C1/1476123457.000100'),
+        ('user', 'update', 'U1')]
+    # changes are read again until acknowledged
+    assert len(m.ChangeLog.read('indexer')) == 3
+
+    m.ChangeLog.ack('indexer', changes[1].seq)
+    assert [log.entity_id for log in m.ChangeLog.read('indexer')] == ['U1']
+    # consumers keep offsets of their own
+    assert len(m.ChangeLog.read('mirror', limit=2)) == 2
+
+    m.ChangeLog.ack('indexer', changes[2].seq)
+    assert m.ChangeLog.read('indexer') == []
+    m.ChangeLog.record('file', 'insert', ['F0123ABCD'])
+    assert [log.entity_id for log in m.ChangeLog.read('indexer')] == ['F0123ABCD']
@@ -0,0 +1,175 @@
+import models as m
+import archv
+
+from conftest import message, create_channel
+
+PARENT = '1476123457.000100'
+
+def reply(ts, **fields):
+    return message(ts, thread_ts=PARENT, **fields)
+
+def sync(conv):
+    sync = archv.ConversationSync(archv.CHANNEL, conv)
+    archv.run_jobs(sync.start())
+    return sync
+
+def last_seq():
+    return m.ChangeLog.select(m.fn.Max(m.ChangeLog.seq)).scalar() or 0
+
+def changes(seq=0):
+    return [(log.entity, log.op, log.entity_id) for log in m.ChangeLog.since(seq)]
+
+def test_refetch_thread(archive, slack):
+    conv = create_channel()
+    parent = message(PARENT, thread_ts=PARENT, latest_reply='1476123458.000100',
+                     attachments=[{'title': 'parent'}])
+    slack.messages['C1'] = [parent]
+    slack.replies[('C1', PARENT)] = [parent, reply('1476123458.000100', attachments=[{'title': 'reply'}])]
+    assert sync(conv).cnt_add == 2
+    first = m.Message.find('C1', '1476123458.000100')
+
+    parent['latest_reply'] = '1476123459.000100'
+    slack.replies[('C1', PARENT)][1]['reactions'] = [{'name': 'tada', 'count': 1, 'users': ['U2']}]
+    slack.replies[('C1', PARENT)].append(reply('1476123459.000100'))
+    seq = last_seq()
+    # only the new reply is counted
+    assert sync(conv).cnt_add == 1
+
+    assert [msg.ts for msg in m.Message.thread('C1', PARENT)] == [
+        1476123457000100, 1476123458000100, 1476123459000100]
+    # unchanged replies and their attachments are kept
+    assert m.Message.find('C1', '1476123458.000100').id == first.id
+    assert m.Attachment.select().count() == 2
+    assert m.Message.find('C1', PARENT).raw['latest_reply'] == '1476123459.000100'
+    assert sorted(changes(seq)) == [
+        ('message', 'insert', 'C1/1476123459.000100'),
+        ('message', 'update', 'C1/' + PARENT),
+        ('reaction', 'insert', 'C1/1476123458.000100/tada/U2')]
+
+def test_thread_reply_deleted(archive, slack):
+    conv = create_channel()
+    parent = message(PARENT, thread_ts=PARENT, latest_reply='1476123459.000100')
+    slack.messages['C1'] = [parent]
+    slack.replies[('C1', PARENT)] = [parent, reply('1476123458.000100'),
+                                     reply('1476123459.000100', text='old')]
+    sync(conv)
+
+    parent['latest_reply'] = '1476123460.000100'
+    slack.replies[('C1', PARENT)] = [
+        parent, reply('1476123459.000100', text='new', edited={'ts': '1476123461.000000'}),
+        reply('1476123460.000100')]
+    seq = last_seq()
+    assert sync(conv).cnt_add == 1
+    assert [msg.text for msg in m.Message.thread('C1', PARENT)] == ['hi', 'new', 'hi']
+    assert sorted(changes(seq)) == [
+        ('message', 'delete', 'C1/1476123458.000100'),
+        ('message', 'insert', 'C1/1476123460.000100'),
+        ('message', 'update', 'C1/' + PARENT),
+        ('message', 'update', 'C1/1476123459.000100')]
+
+def test_history_pages(archive, slack):
+    slack.page_size = 2
+    conv = create_channel()
+    slack.messages['C1'] = [message('147612345{}.000100'.format(i)) for i in range(5)]
+    finished = []
+    sync = archv.ConversationSync(archv.CHANNEL, conv, finished.append)
+    archv.run_jobs(sync.start())
+
+    # pages go back in time from the oldest message of the last one
+    assert slack.calls == [('history', 'C1', None, 1e10),
+                           ('history', 'C1', None, '1476123453.000100'),
+                           ('history', 'C1', None, '1476123451.000100')]
+    assert sync.cnt_add == 5
+    assert finished == [sync]
+    assert conv.length == 5
+    assert len(changes()) == 5
+
+def test_history_since_last_run(archive, slack):
+    conv = create_channel()
+    slack.messages['C1'] = [message('1476123456.000100'), message('1476123457.000100')]
+    sync(conv)
+
+    slack.messages['C1'][0]['edited'] = {'user': 'U1', 'ts': '1476123460.000000'}
+    slack.messages['C1'].append(message('1476123458.000100'))
+    del slack.calls[:]
+    again = sync(conv)
+
+    # new messages since the latest stored, and edits of the ones before it
+    assert sorted(slack.calls, key=str) == [('history', 'C1', '1476123457.000100', 1e10),
+                                            ('history', 'C1', None, '1476123458.000100')]
+    assert again.cnt_add == 1
+    assert [m.ts_to_key(msg.ts) for msg in again.list_mod] == [1476123456000100]
+    assert m.Message.find('C1', '1476123456.000100').edit == {'user': 'U1', 'ts': '1476123460.000000'}
+
+def test_threads_fetched_after_history(archive, slack):
+    slack.page_size = 1
+    conv = create_channel()
+    parents = [message(ts, thread_ts=ts, latest_reply='1476123459.000100')
+               for ts in ['1476123456.000100', '1476123457.000100']]
+    slack.messages['C1'] = parents + [
+        # a parent whose replies are all deleted
+        message('1476123458.000100', thread_ts='1476123458.000100')]
+    for idx, parent in enumerate(parents):
+        slack.replies[('C1', parent['ts'])] = [
+            parent, message('147612346{}.000100'.format(idx), thread_ts=parent['ts'])]
+    assert sync(conv).cnt_add == 5
+
+    kinds = [call[0] for call in slack.calls]
+    assert kinds == ['history'] * 3 + ['replies'] * 2
+    assert sorted(call[2] for call in slack.calls[3:]) == [parent['ts'] for parent in parents]
+    assert [msg.ts for msg in m.Message.thread('C1', '1476123457.000100')] == [
+        1476123457000100, 1476123461000100]
+
+def test_message_older_than_last_reply(archive, slack):
+    conv = create_channel()
+    parent = message(PARENT, thread_ts=PARENT, latest_reply='1476123459.000100')
+    slack.messages['C1'] = [parent]
+    slack.replies[('C1', PARENT)] = [parent, reply('1476123459.000100')]
+    sync(conv)
+
+    # posted to the channel while the thread was fetched
+    slack.messages['C1'].append(message('1476123458.000100'))
+    assert sync(conv).cnt_add == 1
+    assert m.Message.find('C1', '1476123458.000100') is not None
+
+def test_history_interrupted(archive, slack, capsys):
+    slack.page_size = 2
+    conv = create_channel()
+    create_channel('C2', 'random')
+    slack.messages['C1'] = [message('147612345{}.000100'.format(i)) for i in range(6)]
+    slack.messages['C2'] = [message('1476123456.000100')]
+    slack.failures.add(('history', 'C1', None, '1476123454.000100'))
+    archv.fetch_all_message([archv.CHANNEL])
+
+    # other conversations are fetched all the same
+    assert 'general is not fetched completely' in capsys.readouterr().out
+    assert m.Message.select().where(m.Message.channel == 'C2').count() == 1
+    assert m.Message.select().where(m.Message.channel == 'C1').count() == 2
+
+    # older pages are fetched by the next run, and the first one is not saved twice
+    assert sync(conv).cnt_add == 4
+    assert m.Message.select().where(m.Message.channel == 'C1').count() == 6
+    assert len([log for log in changes() if log[2].startswith('C1/')]) == 6
+    del slack.calls[:]
+    sync(conv)
+    assert ('history', 'C1', '1476123455.000100', 1e10) in slack.calls
+
+def test_file_updated(archive):
+    shared = {'id': 'F0123ABCD', 'title': 'a', 'mode': 'hosted', 'filetype': 'png',
+              'mimetype': 'image/png', 'size': 1, 'is_external': False, 'created': 1476123457}
+    archv.process_message(message(PARENT, subtype='file_share', file=dict(shared,
+        initial_comment={'id': 'Fc0123ABCD', 'comment': 'look', 'user': 'U1'})))
+    assert m.File.get().initial_comment.comment == 'look'
+
+    # mentioned again without the comment
+    seq = last_seq()
+    archv.process_message(message('1476123458.000100', subtype='file_mention',
+                                  file=dict(shared)))
+    assert changes(seq) == []
+
+    archv.process_message(message('1476123459.000100', subtype='file_mention',
+                                  file=dict(shared, title='b')))
+    assert changes(seq) == [('file', 'update', 'F0123ABCD')]
+    msgfile = m.File.get()
+    assert msgfile.title == 'b'
+    assert msgfile.initial_comment.id == 'Fc0123ABCD'
@@ -0,0 +1,122 @@
+import json
+
+import models as m
+import archv
+import migrations
+import server
+
+from conftest import settings, message
+
+# tables as created by the first version, before any migration
+BASELINE_SCHEMA = [
+    'CREATE TABLE "message" ("id" INTEGER NOT NULL PRIMARY KEY, "channel_id" VARCHAR(255) NOT NULL, '
+    '"subtype" VARCHAR(255), "text" TEXT, "ts" DATETIME NOT NULL, "user_id" VARCHAR(255), '
+    '"file_id" VARCHAR(255), "attachment_id" INTEGER, "edit" TEXT, "raw" TEXT, '
+    '"updated" DATETIME NOT NULL, FOREIGN KEY ("channel_id") REFERENCES "channel" ("id"), '
+    'FOREIGN KEY ("user_id") REFERENCES "user" ("id"), FOREIGN KEY ("file_id") REFERENCES "file" ("id"), '
+    'FOREIGN KEY ("attachment_id") REFERENCES "attachment" ("id"))',
+    'CREATE INDEX "message_channel_id" ON "message" ("channel_id")',
+    'CREATE INDEX "message_ts" ON "message" ("ts")',
+    'CREATE TABLE "reaction" ("id" INTEGER NOT NULL PRIMARY KEY, "item_type" VARCHAR(255), '
+    '"item_id" DATETIME NOT NULL, "channel_id" VARCHAR(255), "reaction" VARCHAR(255) NOT NULL, '
+    '"user_id" VARCHAR(255) NOT NULL, FOREIGN KEY ("channel_id") REFERENCES "channel" ("id"), '
+    'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))',
+    'CREATE INDEX "reaction_item_id" ON "reaction" ("item_id")',
+]
+
+def create_baseline(path):
+    database = m.SqliteDatabase(path)
+    for sql in BASELINE_SCHEMA:
+        database.execute_sql(sql)
+    messages = [
+        # a thread, whose ts were kept in raw only
+        ('1476123456.000100', {'thread_ts': '1476123456.000100', 'reply_count': 1}),
+        ('1476123457.000000', {'thread_ts': '1476123456.000100'}),
+        ('1476123458.123456', {}),
+    ]
+    for ts, raw in messages:
+        database.execute_sql('INSERT INTO "message" ("channel_id", "text", "ts", "raw", "updated") '
+                             'VALUES (?, ?, ?, ?, ?)', ('C1', 'hi', ts, json.dumps(raw), '2016-10-10'))
+    for item_type, item_id, channel in [('message', '1476123458.123456', 'C1'),
+                                        ('message', '1476123458.654321', 'C1'),
+                                        ('file', 'F0123ABCD', None)]:
+        database.execute_sql('INSERT INTO "reaction" ("item_type", "item_id", "channel_id", '
+                             '"reaction", "user_id") VALUES (?, ?, ?, ?, ?)',
+                             (item_type, item_id, channel, 'tada', 'U1'))
+    database.close()
+
+def open_baseline(tmpdir, monkeypatch):
+    path = str(tmpdir.join('archive.sqlite'))
+    create_baseline(path)
+    monkeypatch.setattr(settings, 'database', path)
+    monkeypatch.setattr(m, 'router', m.ShardRouter())
+    archv.open_archive()
+
+def test_migrate_baseline(tmpdir, monkeypatch):
+    open_baseline(tmpdir, monkeypatch)
+    try:
+        migrations.run(chunk=2, verbose=False)
+
+        assert (list(m.db.execute_sql('SELECT DISTINCT typeof("ts") FROM "message"'))
+                == [('integer',)])
+        assert sorted(m.Message.select(m.Message.ts).tuples()) == [
+            (1476123456000100,), (1476123457000000,), (1476123458123456,)]
+        assert m.Message.find('C1', '1476123457.000000') is not None
+        # threads are read back by thread_ts copied out of raw
+        thread = m.Message.thread('C1', '1476123456.000100')
+        assert [msg.ts for msg in thread] == [1476123456000100, 1476123457000000]
+        assert thread[0].raw == {'reply_count': 1}
+
+        reactions = {r.item_file or r.item_id: r for r in m.Reaction.select()}
+        assert set(reactions) == {1476123458123456, 1476123458654321, 'F0123ABCD'}
+        assert reactions['F0123ABCD'].item_id == 0
+        # the table is not rebuilt
+        assert '"item_id" DATETIME NOT NULL' in m.db.execute_sql(
+            'SELECT sql FROM sqlite_master WHERE name = ?', ('reaction',)).fetchone()[0]
+        # reactions of files can be stored from now on
+        archv.insert_reactions([{'name': 'tada', 'count': 1, 'users': ['U2']}], 'file', 'F0123ABCD')
+        assert m.Reaction.select().where(m.Reaction.item_file == 'F0123ABCD').count() == 1
+
+        assert 'message_channel_id_ts' in {idx.name for idx in m.db.get_indexes('message')}
+        assert migrations.get_state('__data_version') == migrations.MIGRATIONS[-1].version
+        # nothing is left to be done
+        migrations.run(verbose=False)
+        assert m.Message.select().count() == 3
+    finally:
+        m.db.close()
+
+def test_fetch_before_backfill(tmpdir, monkeypatch):
+    open_baseline(tmpdir, monkeypatch)
+    try:
+        migrations.run(backfill=False, verbose=False)
+        # rows not converted yet are read as keys
+        assert sorted(m.Message.select(m.Message.ts).tuples())[1] == (1476123457000000,)
+        reaction = m.Reaction.select().where(m.Reaction.item_type == 'file').get()
+        assert reaction.item_id == 'F0123ABCD'
+
+        # messages are found for edits although their ts are still seconds
+        assert m.Message.find('C1', '1476123457.000000').ts == 1476123457000000
+        assert m.Message.find('C1', '1476123458.123456').ts == 1476123458123456
+        assert m.Message.find('C1', '1476123458.123457') is None
+        # and served with thread_ts still in raw
+        assert server.message_json(m.Message.find('C1', '1476123457.000000'))['thread_ts'] == (
+            '1476123456.000100')
+
+        # only reactions of the very message are replaced
+        archv.insert_reactions([{'name': 'tada', 'count': 1, 'users': ['U2']}],
+                               'message', '1476123458.123456', 'C1')
+        assert sorted(m.Reaction.select(m.Reaction.item_id, m.Reaction.user)
+                      .where(m.Reaction.item_type == 'message').tuples()) == [
+            (1476123458123456, 'U2'), (1476123458654321, 'U1')]
+        assert [(log.op, log.entity_id) for log in m.ChangeLog.select()] == [
+            ('insert', 'C1/1476123458.123456/tada/U2'),
+            ('delete', 'C1/1476123458.123456/tada/U1')]
+
+        # replies saved without thread_ts are replaced rather than duplicated
+        archv.save_thread_replies('C1', '1476123456.000100', [
+            message('1476123456.000100', thread_ts='1476123456.000100'),
+            message('1476123457.000000', thread_ts='1476123456.000100')])
+        assert m.Message.select().count() == 3
+        assert len(m.Message.thread('C1', '1476123456.000100')) == 1
+    finally:
+        m.db.close()
@@ -0,0 +1,104 @@
+import time
+
+import models as m
+import archv
+
+from conftest import message, create_channel
+
+TS = '1476123456.000100'
+ITEM = ('message', TS, 'C1')
+
+def tada(*users, count=None):
+    return [{'name': 'tada', 'count': count or len(users), 'users': list(users)}]
+
+def stored():
+    return sorted(m.Reaction.select(m.Reaction.user).tuples())
+
+def last_seq():
+    return m.ChangeLog.select(m.fn.Max(m.ChangeLog.seq)).scalar() or 0
+
+def changes(seq=0):
+    return sorted((log.op, log.entity_id) for log in m.ChangeLog.since(seq))
+
+def test_truncated_reactions_logged_once_complete(archive, slack):
+    archv.insert_reactions(tada('U1'), *ITEM)
+    seq = last_seq()
+
+    archv.insert_reactions(tada('U2', count=3), *ITEM)
+    # what is known is stored at once, but not logged until complete
+    assert stored() == [('U2',)]
+    assert changes(seq) == []
+
+    slack.full_reactions[('C1', TS)] = tada('U1', 'U2', 'U3')
+    assert archv.fetch_incomplete_reactions() == 1
+    assert stored() == [('U1',), ('U2',), ('U3',)]
+    assert changes(seq) == [('insert', 'C1/{}/tada/U2'.format(TS)),
+                         ('insert', 'C1/{}/tada/U3'.format(TS))]
+
+def test_truncated_reactions_kept_on_failure(archive, slack):
+    archv.insert_reactions(tada('U1'), *ITEM)
+    seq = last_seq()
+
+    archv.insert_reactions(tada('U2', count=3), *ITEM)
+    # the message has been deleted since
+    assert archv.fetch_incomplete_reactions() == 0
+    assert stored() == [('U2',)]
+    assert changes(seq) == [('delete', 'C1/{}/tada/U1'.format(TS)),
+                         ('insert', 'C1/{}/tada/U2'.format(TS))]
+
+def test_queue_kept_across_runs(archive, slack):
+    archv.insert_reactions(tada('U1'), *ITEM)
+    seq = last_seq()
+    archv.insert_reactions(tada('U2', count=3), *ITEM)
+    # stopped before fetching the queue
+    m.db.close()
+    archv.open_archive()
+
+    slack.failures.add(('reactions', TS))
+    assert archv.fetch_incomplete_reactions() == 0
+    assert changes(seq) == []
+
+    slack.full_reactions[('C1', TS)] = tada('U1', 'U2', 'U3')
+    assert archv.fetch_incomplete_reactions() == 1
+    assert stored() == [('U1',), ('U2',), ('U3',)]
+    assert changes(seq) == [('insert', 'C1/{}/tada/U2'.format(TS)),
+                            ('insert', 'C1/{}/tada/U3'.format(TS))]
+    assert m.IncompleteReaction.select().count() == 0
+
+def test_queue_while_fetching(archive, slack):
+    create_channel()
+    truncated = tada('U1', count=2)
+    slack.messages['C1'] = [
+        message(TS, reactions=truncated),
+        message('1476123457.000100', subtype='file_share', file={
+            'id': 'F0123ABCD', 'title': 'a', 'mode': 'hosted', 'filetype': 'png',
+            'mimetype': 'image/png', 'size': 1, 'is_external': False,
+            'created': 1476123457, 'reactions': truncated}),
+        message('1476123458.000100', reactions=tada('U1')),
+    ]
+    archv.fetch_all_message([archv.CHANNEL])
+    assert {queued.item for queued in m.IncompleteReaction.select()} == {
+        ITEM, ('file', 'F0123ABCD', None)}
+
+    # items queued more than once are fetched once
+    archv.insert_reactions(truncated, *ITEM)
+    slack.full_reactions[('C1', TS)] = tada('U1', 'U2')
+    slack.full_reactions['F0123ABCD'] = tada('U1', 'U3')
+    del slack.calls[:]
+    assert archv.fetch_incomplete_reactions() == 2
+    assert sorted(slack.calls) == [('reactions', TS), ('reactions', 'F0123ABCD')]
+    assert m.IncompleteReaction.select().count() == 0
+
+    assert stored() == [('U1',), ('U1',), ('U1',), ('U2',), ('U3',)]
+    assert sorted(m.Reaction.select(m.Reaction.user)
+                  .where(m.Reaction.item_file == 'F0123ABCD').tuples()) == [('U1',), ('U3',)]
+    # nothing is left to fetch
+    assert archv.fetch_incomplete_reactions() == 0
+
+def test_rate_limit():
+    limiter = archv.RateLimiter(600)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.wait()
+    # calls are spaced by a tenth of a second
+    assert time.monotonic() - start >= 0.2
@@ -0,0 +1,101 @@
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+import models as m
+import server
+
+from conftest import message, create_channel
+
+@pytest.fixture
+def get(archive, monkeypatch):
+    ''' Make requests to the server running on a free port, with a cache of its own. '''
+    cache = server.ResponseCache()
+    monkeypatch.setattr(server, 'cache', cache)
+    monkeypatch.setattr(server, 'watcher', server.SyncWatcher(cache, interval=0))
+    httpd = server.Server(('127.0.0.1', 0), server.Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    def request(path, **headers):
+        conn = http.client.HTTPConnection(*httpd.server_address)
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        return resp, body
+
+    yield request
+    httpd.shutdown()
+    httpd.server_close()
+
+def synced(value):
+    m.Information.insert(key='__synced', value=value).upsert().execute()
+
+def test_cache_evicts_least_recently_used():
+    cache = server.ResponseCache(maxsize=2)
+    cache.put('/channels', b'a')
+    cache.put('/users', b'b')
+    # touch the first one, leaving the second the oldest
+    assert cache.get('/channels') == b'a'
+    cache.put('/channels/C024BE91L', b'c')
+    assert cache.get('/users') is None
+    assert cache.get('/channels') == b'a'
+
+def test_cache_expires():
+    cache = server.ResponseCache(ttl=0.01)
+    cache.put('/channels', b'a')
+    time.sleep(0.02)
+    assert cache.get('/channels') is None
+
+def test_messages_leave_out_replies(archive):
+    create_channel()
+    m.Message.api_bulk_insert([dict(msg, channel='C1') for msg in [
+        message('1476123456.000100'),
+        message('1476123457.000100', thread_ts='1476123457.000100'),
+        message('1476123458.000100', thread_ts='1476123457.000100'),
+        message('1476123459.000100', thread_ts='1476123457.000100', subtype='thread_broadcast'),
+    ]])
+    page = server.list_messages({'limit': ['10']}, 'C1')
+    assert [msg['ts'] for msg in page['messages']] == [
+        '1476123459.000100', '1476123457.000100', '1476123456.000100']
+    thread = server.show_thread({}, 'C1', '1476123457.000100')
+    assert len(thread['messages']) == 3
+
+def test_not_modified(get):
+    create_channel()
+    resp, _ = get('/channels')
+    etag = resp.getheader('ETag')
+    assert resp.status == 200 and etag
+
+    resp, body = get('/channels', **{'If-None-Match': etag})
+    assert resp.status == 304
+    assert body == b''
+    # tags change with syncs
+    synced('2016-10-11T00:00:00')
+    resp, _ = get('/channels', **{'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.getheader('ETag') != etag
+
+def test_cache_cleared_after_sync(get):
+    create_channel()
+    assert len(json.loads(get('/channels')[1].decode())['channels']) == 1
+    create_channel('C2', 'random')
+    assert len(json.loads(get('/channels')[1].decode())['channels']) == 1
+    synced('2016-10-11T00:00:00')
+    assert len(json.loads(get('/channels')[1].decode())['channels']) == 2
+
+def test_large_pages_streamed(get):
+    create_channel()
+    m.Message.api_bulk_insert([dict(message('14761{:05}.000100'.format(i)), channel='C1')
+                               for i in range(server.STREAM_LIMIT + 50)])
+    resp, body = get('/channels/C1/messages?limit={}'.format(server.MAX_LIMIT))
+    assert resp.getheader('Transfer-Encoding') == 'chunked'
+    assert resp.getheader('Content-Length') is None
+    messages = json.loads(body.decode())['messages']
+    assert len(messages) == server.STREAM_LIMIT + 50
+    assert messages[0]['ts'] == '1476100249.000100'
+    # streamed pages are not cached
+    assert server.cache.get('/channels/C1/messages?limit={}'.format(server.MAX_LIMIT)) is None
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+import models as m
+import archv
+
+from conftest import message, create_channel
+
+# 2015-06-01, 2016-06-01 and 2016-07-01
+TS_2015 = '1433116800.000100'
+TS_2016 = '1464739200.000100'
+TS_2016_LATER = '1467331200.000100'
+
+def shard_files(tmpdir):
+    return sorted(name for name in os.listdir(str(tmpdir)) if name.startswith('shard.'))
+
+def enable_shards(tmpdir, span=1):
+    m.router.setup(str(tmpdir.join('shard.{year}.sqlite')), span)
+
+def test_route(archive):
+    enable_shards(archive)
+    m.router.prepare([TS_2016])
+    shard = m.router.model(m.Message, 2016)
+    assert m.Message.route(TS_2016) == [shard, m.Message]
+    # rows go to the main table unless their shard is attached
+    assert m.Message.route(TS_2015) == [m.Message]
+    assert m.Message.partitions() == [m.Message, shard]
+    assert m.Message.partitions(since=TS_2016_LATER, reverse=True) == [shard, m.Message]
+
+    m.Message.api_bulk_insert([dict(message(ts), channel='C1') for ts in [TS_2015, TS_2016]])
+    assert shard.select().count() == 1
+    assert m.Message.select().count() == 1
+    assert m.Message.find('C1', TS_2016).ts == m.ts_to_key(TS_2016)
+    assert [msg.ts for msg in m.Message.history('C1')] == [m.ts_to_key(TS_2016), m.ts_to_key(TS_2015)]
+
+def test_split(archive):
+    m.Message.api_bulk_insert([dict(message(ts), channel='C1')
+                               for ts in [TS_2015, TS_2016, TS_2016_LATER]])
+    archv.insert_reactions([{'name': 'tada', 'count': 1, 'users': ['U1']}], 'message', TS_2016, 'C1')
+    archv.insert_reactions([{'name': 'tada', 'count': 1, 'users': ['U1']}], 'file', 'F0123ABCD')
+
+    enable_shards(archive)
+    assert m.split_shards() == 4
+    # shards are created only for years having rows
+    assert shard_files(archive) == ['shard.2015.sqlite', 'shard.2016.sqlite']
+    assert m.Message.select().count() == 0
+    assert m.router.model(m.Message, 2016).select().count() == 2
+    assert m.router.model(m.Reaction, 2016).select().count() == 1
+    # reactions of files stay in the main database
+    assert m.Reaction.select().count() == 1
+    assert m.Message.latest('C1').ts == m.ts_to_key(TS_2016_LATER)
+    assert m.split_shards() == 0
+
+def test_split_interrupted(archive, monkeypatch):
+    m.Message.api_bulk_insert([dict(message(ts), channel='C1') for ts in [TS_2016, TS_2016_LATER]])
+    enable_shards(archive)
+    m.router.prepare([TS_2016])
+    shard = m.router.model(m.Message, 2016)
+    shard.api_bulk_insert([dict(message(TS_2016_LATER, text='fetched'), channel='C1')])
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+    # copied into the shard, but not deleted from the main table
+    with monkeypatch.context() as patch:
+        patch.setattr(m.Message, 'delete', crash)
+        with pytest.raises(KeyboardInterrupt):
+            m.split_shards()
+    assert shard.select().count() == 3
+
+    assert m.split_shards() == 2
+    assert m.Message.select().count() == 0
+    assert sorted(msg.text for msg in shard.select()) == ['fetched', 'hi', 'hi']
+
+def test_split_years(archive):
+    m.Message.api_bulk_insert([dict(message(ts), channel='C1') for ts in [TS_2015, TS_2016]])
+    enable_shards(archive, span=2)
+    m.split_shards()
+    assert shard_files(archive) == ['shard.2014.sqlite', 'shard.2016.sqlite']
+
+def test_fetch_creates_shards_of_years_with_messages(archive, slack):
+    enable_shards(archive)
+    create_channel()
+    slack.messages['C1'] = [message(TS_2016), message(TS_2016_LATER)]
+    archv.fetch_all_message([archv.CHANNEL])
+    assert shard_files(archive) == ['shard.2016.sqlite']
+    assert m.router.model(m.Message, 2016).select().count() == 2
+
+def test_attach_limit(archive):
+    enable_shards(archive)
+    years = ['{}.000000'.format(86400 * 366 * year) for year in range(40, 51)]
+    with pytest.raises(RuntimeError):
+        m.router.prepare(years)
+    assert shard_files(archive) == []
+
+    m.router.prepare(years[:m.ShardRouter.MAX_ATTACHED])
+    for name in shard_files(archive):
+        archive.join(name).copy(archive.join(name.replace('.20', '.19')))
+    # leftover shards are reported before attaching any of them
+    with pytest.raises(RuntimeError):
+        m.ShardRouter().setup(str(archive.join('shard.{year}.sqlite')))
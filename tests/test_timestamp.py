@@ -0,0 +1,25 @@
+import models as m
+
+def test_ts_to_key():
+    assert m.ts_to_key('1476123456.000100') == 1476123456000100
+    assert m.ts_to_key('1476123456') == 1476123456000000
+    # values of older archives are read back as floats
+    assert m.ts_to_key(1476123456.0001) == 1476123456000100
+    assert m.ts_to_key(1476123456000100) == 1476123456000100
+    # whole ts of older archives are read back as integer seconds
+    assert m.ts_to_key(1476123456) == 1476123456000000
+
+def test_legacy_values():
+    field = m.TimestampField()
+    assert field.python_value(1476123456.0001) == 1476123456000100
+    # ids of files reacted to were stored in the same column
+    assert field.python_value('F0123ABCD') == 'F0123ABCD'
+    assert field.python_value(None) is None
+
+def test_key_to_ts():
+    assert m.key_to_ts(1476123456000100) == '1476123456.000100'
+    assert m.key_to_ts(m.ts_to_key('1476123456.999999')) == '1476123456.999999'
+
+def test_message_key():
+    assert m.Message.key('C024BE91L', 1476123456000100) == 'C024BE91L/1476123456.000100'
+    assert m.Message.key('C024BE91L', '1476123456.000100') == 'C024BE91L/1476123456.000100'